@@ -0,0 +1,57 @@
+import json, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+
+class StubServer(object):
+    """
+    Local HTTP server answering every request with handler(request) -> (status, content type, body),
+    request is a dict of method, path, params (query string or form body) and json body.
+    Handled requests are kept in requests.
+    """
+    def __init__(self, handler) -> None:
+        self.handler = handler
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                request = {'method': self.command, 'path': url.path, 'params': params, 'json': None}
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    request['json'] = json.loads(body)
+                else:
+                    params.update({key: values[0] for key, values in parse_qs(body).items()})
+                with stub.lock:
+                    stub.requests.append(request)
+                status, content_type, content = stub.handler(request)
+                content = content.encode() if isinstance(content, str) else content
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            do_GET = _handle
+            do_POST = _handle
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def stub_server():
+    """starts StubServers with the given handler, stopped after the test"""
+    servers = []
+    def start(handler):
+        servers.append(StubServer(handler))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,96 @@
+from io import StringIO
+from urllib.request import Request, urlopen
+import pandas as pd
+import pytest
+from Bio import Entrez, SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from utils import entrez
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov'
+ACCS = [f'AB{idx:06d}.1' for idx in range(1, 6)]
+
+def make_record(acc):
+    rec = SeqRecord(Seq('ATGGCTAAATAG'), id=acc, name=acc.split('.')[0], description='test antibody')
+    rec.annotations['molecule_type'] = 'DNA'
+    return rec
+
+def genbank_text(accs):
+    handle = StringIO()
+    SeqIO.write([make_record(acc) for acc in accs], handle, 'gb')
+    return handle.getvalue()
+
+@pytest.fixture
+def efetch_server(stub_server, monkeypatch):
+    """NCBI efetch stub paging ACCS of query key 1, Bio.Entrez requests are redirected to it"""
+    server = stub_server(None)
+    server.fail_retstarts = set()
+    def handler(request):
+        params = request['params']
+        retstart = int(params.get('retstart', 0))
+        # fail the first request of a page
+        if retstart in server.fail_retstarts:
+            server.fail_retstarts.discard(retstart)
+            return 500, 'text/plain', 'server error'
+        retmax = int(params.get('retmax', len(ACCS)))
+        return 200, 'text/plain', genbank_text(ACCS[retstart:retstart + retmax])
+    server.handler = handler
+    def redirect(request):
+        return urlopen(Request(request.full_url.replace(EUTILS_URL, server.url),
+                               data=request.data, method=request.get_method()))
+    monkeypatch.setattr(Entrez, 'urlopen', redirect)
+    return server
+
+def history_table(accs):
+    return pd.DataFrame(data={'genbank': accs, 'webenv': 'WEBENV1', 'query_key': '1'})
+
+def test_stream_records_pages(efetch_server):
+    records = list(entrez.StreamRecords(history_table(ACCS), retmax=2, n_workers=2, rate=100, verbose=False))
+    assert sorted(rec.id for rec in records) == ACCS
+    assert sorted(int(request['params']['retstart']) for request in efetch_server.requests) == [0, 2, 4]
+    assert all(request['params']['retmax'] == '2' for request in efetch_server.requests)
+
+def test_stream_records_retries_failed_page(efetch_server):
+    entrez_max_tries = Entrez.max_tries
+    efetch_server.fail_retstarts = {2}
+    records = list(entrez.StreamRecords(history_table(ACCS), retmax=2, n_workers=1, rate=100, verbose=False))
+    assert sorted(rec.id for rec in records) == ACCS
+    # one retry by StreamRecords, none inside Bio.Entrez
+    retstarts = [int(request['params']['retstart']) for request in efetch_server.requests]
+    assert sorted(retstarts) == [0, 2, 2, 4]
+    assert Entrez.max_tries == entrez_max_tries
+
+def test_stream_records_gives_up(efetch_server):
+    entrez_max_tries = Entrez.max_tries
+    efetch_server.fail_retstarts = {0}
+    with pytest.raises(OSError):
+        list(entrez.StreamRecords(history_table(ACCS), retmax=5, rate=100, max_tries=1, verbose=False))
+    assert len(efetch_server.requests) == 1
+    assert Entrez.max_tries == entrez_max_tries
+
+def test_fetch_records_store_hit(efetch_server, tmp_path):
+    store = entrez.RecordStore(str(tmp_path / 'records.db'))
+    store.put([make_record(acc) for acc in ACCS])
+    records = entrez.FetchRecords(history_table(ACCS), store=store)
+    assert sorted(rec.id for rec in records) == ACCS
+    assert len(efetch_server.requests) == 0
+    # unversioned accessions resolve to the stored version
+    assert store.contains(['AB000001']) == {'AB000001'}
+
+def test_fetch_records_store_miss(efetch_server, tmp_path):
+    store = entrez.RecordStore(str(tmp_path / 'records.db'))
+    store.put([make_record(acc) for acc in ACCS[:2]])
+    records = entrez.FetchRecords(history_table(ACCS), store=store)
+    # fetched records are not duplicated with stored ones and are stored
+    assert sorted(rec.id for rec in records) == ACCS
+    assert len(efetch_server.requests) == 1
+    assert len(store) == len(ACCS)
+    entrez.FetchRecords(history_table(ACCS), store=store)
+    assert len(efetch_server.requests) == 1
+
+def test_fetch_records_offline_miss(efetch_server, tmp_path):
+    store = entrez.RecordStore(str(tmp_path / 'records.db'), offline=True)
+    store.put([make_record(acc) for acc in ACCS[:2]])
+    records = entrez.FetchRecords(history_table(ACCS), store=store)
+    assert sorted(rec.id for rec in records) == ACCS[:2]
+    assert len(efetch_server.requests) == 0
@@ -0,0 +1,88 @@
+import json
+import pytest
+from utils import pdbinfo
+
+def make_entry(pdbcode):
+    return {
+        'rcsb_id': pdbcode,
+        'struct': {'title': f'{pdbcode} antibody complex'},
+        'polymer_entities': [{
+            'rcsb_polymer_entity_container_identifiers': {'entity_id': '1', 'asym_ids': ['A', 'B']},
+            'rcsb_polymer_entity': {'pdbx_description': 'heavy chain'},
+            'rcsb_polymer_entity_annotation': None,
+            'entity_poly': {'pdbx_seq_one_letter_code_can': 'EVQLV'},
+            'polymer_entity_instances': [
+                {'rcsb_polymer_entity_instance_container_identifiers': {'asym_id': asym_id, 'auth_asym_id': auth_asym_id},
+                 'rcsb_polymer_instance_annotation': None}
+                for asym_id, auth_asym_id in [('A', 'H'), ('B', 'I')]],
+        }],
+    }
+
+ENTRIES = {pdbcode: make_entry(pdbcode) for pdbcode in ['7XYZ', '8ABC']}
+
+@pytest.fixture
+def graphql_server(stub_server, monkeypatch):
+    """RCSB GraphQL stub of ENTRIES used by the shared client, unknown entries are null"""
+    server = stub_server(None)
+    server.n_failures = 0
+    server.n_invalid = 0
+    def handler(request):
+        if server.n_failures > 0:
+            server.n_failures -= 1
+            return 503, 'text/plain', 'unavailable'
+        if server.n_invalid > 0:
+            server.n_invalid -= 1
+            return 200, 'text/html', '<html>maintenance</html>'
+        entry_ids = request['json']['variables']['entry_ids']
+        data = {'entries': [ENTRIES.get(entry_id) for entry_id in entry_ids]}
+        return 200, 'application/json', json.dumps({'data': data})
+    server.handler = handler
+    monkeypatch.setattr(pdbinfo, '_client', pdbinfo.RCSBClient(url=server.url, max_tries=3, backoff=0))
+    return server
+
+def test_build_idmapping_many(graphql_server):
+    idmapping = pdbinfo.build_idmapping_many(['7xyz', '8ABC', '7XYZ'])
+    # one query with unique upper case codes
+    assert len(graphql_server.requests) == 1
+    assert graphql_server.requests[0]['json']['variables'] == {'entry_ids': ['7XYZ', '8ABC']}
+    assert list(idmapping.pdbcode) == ['7XYZ', '7XYZ', '8ABC', '8ABC']
+    assert list(idmapping.auth_instance_id) == ['H', 'I', 'H', 'I']
+    assert set(idmapping.sequence) == {'EVQLV'}
+
+def test_build_idmapping_many_missing_entry(graphql_server, capsys):
+    idmapping = pdbinfo.build_idmapping_many(['7XYZ', '0000', '8ABC'], batch_size=2)
+    assert len(graphql_server.requests) == 2
+    assert sorted(set(idmapping.pdbcode)) == ['7XYZ', '8ABC']
+    assert '0000 not found' in capsys.readouterr().out
+
+def test_build_idmapping_many_retries(graphql_server):
+    graphql_server.n_failures = 2
+    idmapping = pdbinfo.build_idmapping_many(['7XYZ'])
+    assert len(graphql_server.requests) == 3
+    assert len(idmapping) == 2
+
+def test_build_idmapping_many_request_error(graphql_server):
+    graphql_server.n_failures = 3
+    with pytest.raises(pdbinfo.RCSBRequestError) as excinfo:
+        pdbinfo.build_idmapping_many(['7XYZ'])
+    assert excinfo.value.status_code == 503
+
+def test_build_idmapping_many_invalid_json(graphql_server):
+    graphql_server.n_invalid = 1
+    assert len(pdbinfo.build_idmapping_many(['7XYZ'])) == 2
+    graphql_server.n_invalid = 3
+    with pytest.raises(pdbinfo.RCSBRequestError) as excinfo:
+        pdbinfo.build_idmapping_many(['8ABC'])
+    assert excinfo.value.status_code == 200
+
+def test_client_max_tries():
+    with pytest.raises(ValueError):
+        pdbinfo.RCSBClient(max_tries=0)
+
+def test_build_idmapping_many_cached(graphql_server, tmp_path):
+    cache = pdbinfo.enable_cache(str(tmp_path / 'responses.db'))
+    first = pdbinfo.build_idmapping_many(['7XYZ', '8ABC'])
+    second = pdbinfo.build_idmapping_many(['7XYZ', '8ABC'])
+    assert len(graphql_server.requests) == 1
+    assert first.equals(second)
+    assert cache.stats()['hits'] == 1
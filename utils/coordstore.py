@@ -0,0 +1,100 @@
+import os, json
+import numpy as np
+from tqdm import tqdm
+from .structure import get_ca_arrays, load_structure
+
+# per-atom arrays of the store: file name, dtype, shape of one atom
+STORE_ARRAYS = {
+    'coords': ('coords.f32', np.float32, (3,)),
+    'entry_idx': ('entry.i32', np.int32, ()),
+    'chain': ('chain.s4', 'S4', ()),
+    'resid': ('resid.i32', np.int32, ()),
+    'atom_name': ('atom_name.s4', 'S4', ()),
+}
+
+def _read_atoms(fpath, atoms='CA'):
+    """coordinates, auth chains, auth residue numbers and atom names of one structure"""
+    if atoms == 'CA':
+        ca = get_ca_arrays(fpath)
+        return ca.pos, ca.chain, ca.resid, np.full(len(ca.pos), 'CA')
+    elif atoms == 'backbone':
+        structure = load_structure(fpath, use_author_chain=True, backbone=True)
+        return structure.coord, structure.chain_id, structure.res_id, structure.atom_name
+    else:
+        raise ValueError('atoms must be CA or backbone')
+
+def build_coordstore(structure_files, store_dir, atoms='CA', verbose=True):
+    """
+    Builds a memory-mappable coordinate store of many structures (complexes, IgFold models ...).
+    structure_files: dict of entry name -> file path, or list of file paths named by their basename
+    atoms: 'CA' (via get_ca_arrays) or 'backbone' N/CA/C atoms (via load_structure)
+    Atoms of all entries are appended to flat binary arrays, entry i spans offsets[i]:offsets[i+1].
+    """
+    if not isinstance(structure_files, dict):
+        structure_files = {os.path.basename(fpath).split('.')[0]: fpath for fpath in structure_files}
+    os.makedirs(store_dir, exist_ok=True)
+    fouts = {key: open(os.path.join(store_dir, fname), 'wb') for key, (fname, _, _) in STORE_ARRAYS.items()}
+    names, offsets, failed = [], [0], {}
+    for name, fpath in tqdm(structure_files.items(), disable=not verbose):
+        try:
+            coords, chains, resids, atom_names = _read_atoms(fpath, atoms)
+        except Exception as e:
+            failed[name] = f'{type(e).__name__}: {e}'
+            continue
+        entry_arrays = {'coords': coords, 'entry_idx': np.full(len(coords), len(names)),
+                        'chain': chains, 'resid': resids, 'atom_name': atom_names}
+        for key, (_, dtype, _) in STORE_ARRAYS.items():
+            np.asarray(entry_arrays[key]).astype(dtype).tofile(fouts[key])
+        names.append(name)
+        offsets.append(offsets[-1] + len(coords))
+    for fout in fouts.values():
+        fout.close()
+    np.save(os.path.join(store_dir, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    meta = {'atoms': atoms, 'n_atoms': offsets[-1], 'names': names, 'failed': failed}
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as fout:
+        json.dump(meta, fout)
+    if len(failed) > 0:
+        print(f'{len(failed)} structures failed')
+    return CoordStore(store_dir)
+
+class CoordStore(object):
+    """
+    Read-only view of a store built by build_coordstore.
+    Arrays are memory-mapped, so slicing an entry is zero-copy.
+    """
+    def __init__(self, store_dir) -> None:
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as fin:
+            meta = json.load(fin)
+        self.atoms = meta['atoms']
+        self.names = meta['names']
+        self.failed = meta['failed']
+        self.name_idx = {name: idx for idx, name in enumerate(self.names)}
+        self.offsets = np.load(os.path.join(store_dir, 'offsets.npy'))
+        n_atoms = meta['n_atoms']
+        for key, (fname, dtype, shape) in STORE_ARRAYS.items():
+            if n_atoms == 0:
+                arr = np.empty((0,) + shape, dtype=dtype)
+            else:
+                arr = np.memmap(os.path.join(store_dir, fname), dtype=dtype, mode='r', shape=(n_atoms,) + shape)
+            setattr(self, key, arr)
+    def __len__(self):
+        return len(self.names)
+    def __contains__(self, name):
+        return name in self.name_idx
+    def span(self, name):
+        """atom slice of an entry"""
+        idx = self.name_idx[name]
+        return slice(int(self.offsets[idx]), int(self.offsets[idx + 1]))
+    def __getitem__(self, name):
+        """coordinates of an entry"""
+        return self.coords[self.span(name)]
+    def get(self, name, chains=None):
+        """coords, chain, resid & atom_name arrays of an entry, optionally subset to chains"""
+        span = self.span(name)
+        entry = {'coords': self.coords[span], 'chain': self.chain[span].astype(str),
+                 'resid': self.resid[span], 'atom_name': self.atom_name[span].astype(str)}
+        if chains is not None:
+            mask = np.isin(entry['chain'], chains)
+            entry = {key: value[mask] for key, value in entry.items()}
+        return entry
@@ -1,14 +1,25 @@
+import time, threading, sqlite3, zlib, hashlib
+import http.client
+from contextlib import contextmanager
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import pandas as pd
 from tqdm import tqdm
 from Bio import Entrez, SeqIO
+from Bio.Seq import Seq
 Entrez.email = ""
 Entrez.api_key = ""
 
-def SearchGenBank(query):
+def SearchGenBank(query, store=None):
+    # replay stored search without network
+    if store is not None and store.offline:
+        return store.get_search(query)
     # fetch record from genbank
     handle = Entrez.esearch(db="nucleotide", term=f'"{query}"', idtype='acc', usehistory="y")
     record = Entrez.read(handle)
     handle.close()
+    if store is not None:
+        store.put_search(query, record['IdList'], record['WebEnv'], record['QueryKey'])
     # convert to dataframe
     if len(record['IdList']) > 0:
         result_df = pd.DataFrame(data={'genbank': record['IdList']})
@@ -18,7 +29,18 @@ def SearchGenBank(query):
         return result_df
 
 # upload ids to genbank history
-def UploadIds(ids, batch_size=500, db='nucleotide'):
+def UploadIds(ids, batch_size=500, db='nucleotide', store=None):
+    # only upload ids missing from the record store
+    if store is not None:
+        cached_ids = store.contains(ids)
+        missing_ids = [i for i in ids if i not in cached_ids]
+        result_df = pd.DataFrame(data={'genbank': [i for i in ids if i in cached_ids], 'webenv': None, 'query_key': None})
+        if len(missing_ids) > 0:
+            if store.offline:
+                print(f'{len(missing_ids)} ids not in record store')
+            else:
+                result_df = pd.concat([result_df, UploadIds(missing_ids, batch_size, db)], ignore_index=True)
+        return result_df
     result_df = pd.DataFrame(data={'genbank': ids})
     for startidx in tqdm(range(0, len(ids), batch_size)):
         endidx = startidx + batch_size
@@ -33,25 +55,256 @@ def UploadIds(ids, batch_size=500, db='nucleotide'):
     return result_df
 
 # fetch records from genbank
-def FetchRecords(result_df, db='nucleotide'):
+def FetchRecords(result_df, db='nucleotide', stream=False, store=None, **kwargs):
+    # stream records page by page
+    if stream:
+        return StreamRecords(result_df, db=db, store=store, **kwargs)
+    # records already in store
+    records, result_df = _split_cached(result_df, store)
+    cached_accs = set(rec.id for rec in records)
     # drop duplicate webenvs & query_keys
     result_df = result_df.drop_duplicates(subset=['webenv', 'query_key'])
     # fetch records
-    records = []
     for idx, row in tqdm(result_df.iterrows(), total=len(result_df)):
         handle = Entrez.efetch(db=db, rettype="gb", retmode="text", webenv=row['webenv'], query_key=row['query_key'])
-        records = records + list(SeqIO.parse(handle, "gb"))
+        fetched = [rec for rec in SeqIO.parse(handle, "gb") if rec.id not in cached_accs]
         handle.close()
+        if store is not None:
+            store.put(fetched)
+        records.extend(fetched)
     return records
 
+def _split_cached(result_df, store):
+    """get stored records and the rows of history keys still to be fetched"""
+    if store is None:
+        return [], result_df
+    cached = store.get(result_df['genbank'])
+    missing_mask = ~result_df['genbank'].isin(list(cached.keys()))
+    # only history keys with missing ids need to be fetched
+    missing_df = result_df.loc[missing_mask]
+    if store.offline:
+        if len(missing_df) > 0:
+            print(f'{len(missing_df)} ids not in record store')
+        missing_df = missing_df.iloc[:0]
+    missing_keys = missing_df[['webenv', 'query_key']].dropna().drop_duplicates()
+    remaining_df = result_df.merge(missing_keys, on=['webenv', 'query_key'])
+    return list(cached.values()), remaining_df
+
+# limit requests per second shared by all fetching threads
+class RateLimiter(object):
+    def __init__(self, rate=None) -> None:
+        # NCBI allows 3 requests/s without api key, 10 requests/s with it
+        if rate is None:
+            rate = 10 if Entrez.api_key else 3
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+# Bio.Entrez retries on its own (Entrez.max_tries with long sleeps) unless set to a single try
+_single_try_lock = threading.Lock()
+_single_try_count = 0
+_saved_max_tries = None
+
+@contextmanager
+def _entrez_single_try():
+    """Entrez.max_tries set to 1 while any thread is inside, restored when the last one leaves"""
+    global _single_try_count, _saved_max_tries
+    with _single_try_lock:
+        if _single_try_count == 0:
+            _saved_max_tries = Entrez.max_tries
+            Entrez.max_tries = 1
+        _single_try_count += 1
+    try:
+        yield
+    finally:
+        with _single_try_lock:
+            _single_try_count -= 1
+            if _single_try_count == 0:
+                Entrez.max_tries = _saved_max_tries
+
+def _fetch_batch(db, webenv, query_key, retstart, retmax, limiter, max_tries=5, backoff=1.0):
+    """fetch one page of a history key, retry with exponential backoff (the only retry layer)"""
+    for attempt in range(max_tries):
+        limiter.wait()
+        try:
+            with _entrez_single_try():
+                handle = Entrez.efetch(db=db, rettype="gb", retmode="text", webenv=webenv, query_key=query_key,
+                                       retstart=retstart, retmax=retmax)
+                records = list(SeqIO.parse(handle, "gb"))
+                handle.close()
+            return records
+        except (OSError, ValueError, http.client.HTTPException):
+            if attempt == max_tries - 1:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+# fetch records from genbank as a stream
+def StreamRecords(result_df, db='nucleotide', retmax=200, n_workers=3, rate=None, max_tries=5, store=None, verbose=True):
+    """
+    Yields SeqRecords of the uploaded ids as batches arrive.
+    Each webenv/query_key is paged with retstart/retmax and pages are fetched concurrently
+    while keeping below the NCBI requests-per-second limit.
+    """
+    limiter = RateLimiter(rate)
+    # records already in store
+    cached_records, result_df = _split_cached(result_df, store)
+    cached_accs = set(rec.id for rec in cached_records)
+    yield from cached_records
+    # number of ids behind each history key
+    counts = result_df.groupby(['webenv', 'query_key'], sort=False).size()
+    batches = [(webenv, query_key, retstart)
+               for (webenv, query_key), count in counts.items()
+               for retstart in range(0, count, retmax)]
+    pbar = tqdm(total=int(counts.sum()), disable=not verbose)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # keep a bounded number of pages in flight
+        running = set()
+        for webenv, query_key, retstart in batches:
+            running.add(executor.submit(_fetch_batch, db, webenv, query_key, retstart, retmax, limiter, max_tries))
+            if len(running) < n_workers * 2:
+                continue
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from _collect_batch(future, pbar, store, cached_accs)
+        for future in as_completed(running):
+            yield from _collect_batch(future, pbar, store, cached_accs)
+    pbar.close()
+
+def _collect_batch(future, pbar, store, cached_accs):
+    records = [rec for rec in future.result() if rec.id not in cached_accs]
+    pbar.update(len(records))
+    if store is not None:
+        store.put(records)
+    return records
+
+# on-disk genbank records keyed by accession.version
+class RecordStore(object):
+    """
+    SQLite store of zlib-compressed GenBank records keyed by accession.version.
+    Unversioned accessions resolve to the latest stored version.
+    In offline mode fetches are served only from the store.
+    """
+    def __init__(self, db_path, offline=False) -> None:
+        self.db_path = db_path
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS records (accver TEXT PRIMARY KEY, acc TEXT, version INTEGER, record BLOB, fetched REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS records_acc ON records (acc)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS searches (query TEXT PRIMARY KEY, ids TEXT, webenv TEXT, query_key TEXT, fetched REAL)")
+        self.conn.commit()
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+    def _lookup(self, id, column='record'):
+        if '.' in id:
+            sql = f"SELECT {column} FROM records WHERE accver=?"
+        else:
+            sql = f"SELECT {column} FROM records WHERE acc=? ORDER BY version DESC LIMIT 1"
+        return self.conn.execute(sql, (id,)).fetchone()
+    def contains(self, ids):
+        """ids present in the store"""
+        with self.lock:
+            return set(id for id in ids if self._lookup(id, 'accver') is not None)
+    def get(self, ids):
+        """dict of id -> SeqRecord for stored ids"""
+        records = {}
+        with self.lock:
+            for id in ids:
+                row = self._lookup(id)
+                if row is not None:
+                    records[id] = SeqIO.read(StringIO(zlib.decompress(row[0]).decode()), "gb")
+        return records
+    def put(self, records):
+        rows = []
+        now = time.time()
+        for rec in records:
+            acc, _, version = rec.id.partition('.')
+            rows.append((rec.id, acc, int(version) if version.isdigit() else 0,
+                         zlib.compress(rec.format("gb").encode()), now))
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO records VALUES (?,?,?,?,?)", rows)
+            self.conn.commit()
+    def get_search(self, query):
+        """replay a stored SearchGenBank result"""
+        with self.lock:
+            row = self.conn.execute("SELECT ids, webenv, query_key FROM searches WHERE query=?", (query,)).fetchone()
+        if row is None or len(row[0]) == 0:
+            return None
+        result_df = pd.DataFrame(data={'genbank': row[0].split(';')})
+        result_df.loc[:, 'query'] = query
+        result_df.loc[:, 'webenv'] = row[1]
+        result_df.loc[:, 'query_key'] = row[2]
+        return result_df
+    def put_search(self, query, ids, webenv, query_key):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO searches VALUES (?,?,?,?,?)",
+                              (query, ';'.join(ids), webenv, query_key, time.time()))
+            self.conn.commit()
+    def prune(self, max_age=None, max_records=None):
+        """remove records older than max_age seconds, then the oldest beyond max_records"""
+        with self.lock:
+            if max_age is not None:
+                cutoff = time.time() - max_age
+                self.conn.execute("DELETE FROM records WHERE fetched < ?", (cutoff,))
+                self.conn.execute("DELETE FROM searches WHERE fetched < ?", (cutoff,))
+            if max_records is not None:
+                self.conn.execute("DELETE FROM records WHERE accver NOT IN (SELECT accver FROM records ORDER BY fetched DESC LIMIT ?)", (max_records,))
+            self.conn.commit()
+    def close(self):
+        self.conn.close()
+
 # translate mab records to protein
 def TranslateMab(rec):
     # if with cds feature, use it
-    feat_types = [feat.type for feat in rec.features]
-    if 'CDS' in feat_types:
-        cds_feat = [feat for feat in rec.features if feat.type == 'CDS'][0]
+    cds_feat = next((feat for feat in rec.features if feat.type == 'CDS'), None)
+    if cds_feat is not None:
         seq = cds_feat.qualifiers['translation'][0]
     # if without cds feature, use whole sequence for translation
     else:
         seq = rec.seq.translate(to_stop=True)
-    return seq
\ No newline at end of file
+    return seq
+
+def _translate_nt(nt_seq):
+    return str(Seq(nt_seq).translate(to_stop=True))
+
+# translate batch of mab records to protein
+def TranslateMabBatch(records, n_jobs=1, memo=None, chunksize=64):
+    """
+    Translates records to a table of accession and protein sequence.
+    CDS translations are taken directly; other records are translated in a process pool,
+    memoized by nucleotide sequence hash so duplicated sequences are translated once.
+    """
+    memo = {} if memo is None else memo
+    accs, prots = [], []
+    pending, to_translate = [], {}
+    for rec in records:
+        accs.append(rec.id)
+        cds_feat = next((feat for feat in rec.features if feat.type == 'CDS'), None)
+        if cds_feat is not None and 'translation' in cds_feat.qualifiers:
+            prots.append(cds_feat.qualifiers['translation'][0])
+        else:
+            nt_seq = str(rec.seq).upper()
+            seq_hash = hashlib.sha1(nt_seq.encode()).hexdigest()
+            if seq_hash not in memo:
+                to_translate[seq_hash] = nt_seq
+            pending.append((len(prots), seq_hash))
+            prots.append(None)
+    # translate unique sequences
+    hashes = list(to_translate.keys())
+    nt_seqs = list(to_translate.values())
+    if n_jobs > 1 and len(nt_seqs) > chunksize:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            translated = list(executor.map(_translate_nt, nt_seqs, chunksize=chunksize))
+    else:
+        translated = [_translate_nt(nt_seq) for nt_seq in nt_seqs]
+    memo.update(zip(hashes, translated))
+    for idx, seq_hash in pending:
+        prots[idx] = memo[seq_hash]
+    return pd.DataFrame(data={'genbank': accs, 'protein': prots})
\ No newline at end of file
@@ -2,11 +2,15 @@ import pandas as pd
 import numpy as np
 from igfold import IgFoldRunner
 from igfold.utils.pdb import save_PDB
-import argparse, os
+import argparse, os, multiprocessing, hashlib, json, shutil, glob, time
 from tqdm import tqdm
 from Bio import SeqIO
 from io import StringIO
-import sys
+try:
+    from .sequence import standardize_seq
+except ImportError:
+    # run as a script from utils/
+    from sequence import standardize_seq
 
 def parser_args():
     parser = argparse.ArgumentParser()
@@ -19,20 +23,16 @@ def parser_args():
     parser.add_argument('--refine', action='store_true', default=False, help='refine')
     parser.add_argument('--output_dir', type=str, help='path to output dir')
     parser.add_argument('--num_models', action='store', type=int, default=4, help='number of models')
+    parser.add_argument('--num_workers', default=1, type=int, help='number of worker processes')
+    parser.add_argument('--threads_per_worker', default=None, type=int, help='torch threads of each worker')
+    parser.add_argument('--max_tries', default=3, type=int, help='max tries of each antibody')
+    parser.add_argument('--archive_dir', default=None, type=str, help='write models to npz shards in this dir instead of pdb files')
+    parser.add_argument('--shard_size', default=1000, type=int, help='number of models in each archive shard')
+    parser.add_argument('--flush_every', default=50, type=int, help='write archived models at least every this many models')
+    parser.add_argument('--flush_interval', default=600, type=float, help='write archived models at least every this many seconds')
     
     return parser
 
-def standardize_seq(seq, standard_aa_str="ARNDCQEGHILKMFPSTWYV"):
-    # upper
-    seq = seq.upper()
-    # only standard aa
-    standard_aas = list(standard_aa_str)
-    seq_list = list(seq)
-    for idx, aa in enumerate(seq_list):
-        if aa not in standard_aas:
-            seq_list[idx] = 'A'
-    return ''.join(seq_list)
-
 def prepare_inputs(args, seqtable=None):
     # load table
     input_table_df = pd.read_table(args.input_seqtable_path) if seqtable is None else seqtable
@@ -68,47 +68,410 @@ def check_model_seq(pdb_filepath, seq):
     pdb_seq = ''.join([str(x.seq) for x in pdb_seqrecs])
     return pdb_seq == seq
 
+def check_model_arrays(coords, seq):
+    """in memory check of predicted coords against the sequence"""
+    return coords.shape[0] == len(seq) and bool(np.isfinite(coords).all())
+
+def output_arrays(output, seq):
+    """float32 N/CA/C/CB/O coords and per-residue prediction error of an IgFold output"""
+    coords = output.coords.squeeze(0).detach().cpu().numpy().astype(np.float32)
+    if getattr(output, 'prmsd', None) is not None:
+        error = output.prmsd.squeeze(0).detach().cpu().numpy().astype(np.float32).reshape(len(coords), -1)
+    else:
+        error = np.zeros((len(coords), 1), dtype=np.float32)
+    return coords, error
+
+def fold_one(runner, seqdict, idx, output_dir, args, write2file=True, return_arrays=False):
+    """
+    fold one antibody, write {idx}.pdb, return the pdb string buffer or
+    (coords, error) arrays if return_arrays,
+    retrying at most args.max_tries times when the model sequence is wrong
+    """
+    output_filepath = os.path.join(output_dir, f'{idx}.pdb')
+    max_tries = getattr(args, 'max_tries', 3)
+    # IgFold only needs to write its own pdb for refinement
+    skip_pdb = not args.refine
+    for _ in range(max_tries):
+        try:
+            output = runner.fold(output_filepath, sequences=seqdict, 
+                                do_refine=args.refine, do_renum=False, skip_pdb=skip_pdb)
+        except RuntimeError:
+            output = runner.fold(output_filepath, sequences=seqdict, 
+                                do_refine=False, do_renum=False, skip_pdb=True)
+        # output 
+        seq = "".join(seqdict.values())
+        chains = list(seqdict.keys())
+        delims = np.cumsum([len(s) for s in seqdict.values()]).tolist()
+        if return_arrays:
+            coords, error = output_arrays(output, seq)
+            if check_model_arrays(coords, seq):
+                return coords, error
+        elif write2file:
+            pdb_string = save_PDB(None, output.coords.squeeze(), seq, chains=chains, delim=delims, atoms=['N', 'CA', 'C', 'CB', 'O'], write_pdb=False)
+            # check output pdb in memory before writing
+            if check_model_seq(StringIO(pdb_string), seq):
+                with open(output_filepath, 'w') as fout:
+                    fout.write(pdb_string)
+                return
+        else:
+            pdb_string = save_PDB(None, output.coords.squeeze(), seq, chains=chains, delim=delims, atoms=['N', 'CA', 'C', 'CB', 'O'], write_pdb=False)
+            return StringIO(pdb_string)
+    raise RuntimeError(f'model sequence mismatch after {max_tries} tries')
+
+class ModelArchive(object):
+    """
+    Chunked archive of predicted models as NPZ shards (models_00000.npz ...) in archive_dir.
+    Each shard holds up to shard_size models: concatenated N/CA/C/CB/O coords & prediction errors
+    with residue offsets, sequences, sequence hashes, chain ids and chain delimiters.
+    Buffered models are written every flush_every models or flush_interval seconds,
+    and only then recorded as done in the optional RunManifest.
+    """
+    def __init__(self, archive_dir, shard_size=1000, flush_every=50, flush_interval=600, manifest=None) -> None:
+        self.archive_dir = archive_dir
+        self.shard_size = shard_size
+        self.flush_every = min(flush_every, shard_size)
+        self.flush_interval = flush_interval
+        self.manifest = manifest
+        self.buffer = []
+        self.last_flush = time.time()
+        os.makedirs(archive_dir, exist_ok=True)
+        self.shard_paths = sorted(glob.glob(os.path.join(archive_dir, 'models_*.npz')))
+        self._index = None
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.flush()
+    def add(self, idx, seqdict, coords, error):
+        self.buffer.append((str(idx), seqdict, coords, error))
+        if len(self.buffer) >= self.flush_every or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+    def _next_shard_path(self):
+        # number after the highest shard, so that a gap left by a deleted shard is never overwritten
+        shard_nums = [int(os.path.basename(path)[len('models_'):-len('.npz')]) for path in self.shard_paths]
+        return os.path.join(self.archive_dir, f'models_{max(shard_nums, default=-1) + 1:05d}.npz')
+    def flush(self):
+        self.last_flush = time.time()
+        if len(self.buffer) == 0:
+            return
+        idxs, seqdicts, coords, errors = zip(*self.buffer)
+        res_offsets = np.zeros(len(coords) + 1, dtype=np.int64)
+        res_offsets[1:] = np.cumsum([len(c) for c in coords])
+        shard_path = self._next_shard_path()
+        # write atomically
+        with open(shard_path + '.tmp', 'wb') as fout:
+            np.savez_compressed(fout, idxs=np.array(idxs),
+                                seqs=np.array([''.join(seqdict.values()) for seqdict in seqdicts]),
+                                seq_keys=np.array([seqdict_key(seqdict) for seqdict in seqdicts]),
+                                chains=np.array([''.join(seqdict.keys()) for seqdict in seqdicts]),
+                                delims=np.array([','.join(str(len(s)) for s in seqdict.values()) for seqdict in seqdicts]),
+                                coords=np.concatenate(coords), errors=np.concatenate(errors), res_offsets=res_offsets)
+        os.replace(shard_path + '.tmp', shard_path)
+        self.shard_paths.append(shard_path)
+        if self.manifest is not None:
+            sha1 = file_sha1(shard_path)
+            for idx, seqdict in zip(idxs, seqdicts):
+                self.manifest.record(idx, seqdict_key(seqdict), 'done', shard_path, sha1=sha1)
+        self.buffer = []
+        self._index = None
+    def index(self):
+        """idx -> (shard path, position, sequence, sequence hash) of archived models"""
+        if self._index is None:
+            self._index = {}
+            self._key_index = {}
+            for shard_path in self.shard_paths:
+                with np.load(shard_path) as shard:
+                    for pos, (idx, seq, seq_key) in enumerate(zip(shard['idxs'], shard['seqs'], shard['seq_keys'])):
+                        self._index[str(idx)] = (shard_path, pos, str(seq), str(seq_key))
+            # later models of an idx replace earlier ones
+            for idx, (_, _, _, seq_key) in self._index.items():
+                self._key_index[seq_key] = idx
+        return self._index
+    def has(self, idx, seq_key):
+        """whether idx is archived (or buffered) with the same sequences"""
+        if any(buffered[0] == str(idx) and seqdict_key(buffered[1]) == seq_key for buffered in self.buffer):
+            return True
+        entry = self.index().get(str(idx))
+        return entry is not None and entry[3] == seq_key
+    def find(self, seq_key):
+        """idx of an archived (or buffered) model of the same sequences"""
+        for idx, seqdict, _, _ in self.buffer:
+            if seqdict_key(seqdict) == seq_key:
+                return idx
+        self.index()
+        return self._key_index.get(seq_key)
+    def copy(self, src_idx, idx):
+        """archive the model of src_idx under idx"""
+        for buffered_idx, seqdict, coords, error in self.buffer:
+            if buffered_idx == str(src_idx):
+                break
+        else:
+            seqdict, coords, error = self.load(src_idx)
+        self.add(idx, seqdict, coords.copy(), error.copy())
+    def load(self, idx):
+        """seqdict, coords & error of an archived model"""
+        shard_path, pos = self.index()[str(idx)][:2]
+        with np.load(shard_path) as shard:
+            start, stop = shard['res_offsets'][pos], shard['res_offsets'][pos + 1]
+            seq, chains = str(shard['seqs'][pos]), str(shard['chains'][pos])
+            lengths = [int(l) for l in str(shard['delims'][pos]).split(',')]
+            coords, error = shard['coords'][start:stop], shard['errors'][start:stop]
+        bounds = np.cumsum([0] + lengths)
+        seqdict = {chain: seq[a:b] for chain, a, b in zip(chains, bounds[:-1], bounds[1:])}
+        return seqdict, coords, error
+    def export_pdb(self, idx, output_filepath=None):
+        """write an archived model as pdb, return the pdb string"""
+        import torch
+        seqdict, coords, error = self.load(idx)
+        seq = ''.join(seqdict.values())
+        delims = np.cumsum([len(s) for s in seqdict.values()]).tolist()
+        pdb_string = save_PDB(None, torch.from_numpy(coords), seq, chains=list(seqdict.keys()), delim=delims,
+                              atoms=['N', 'CA', 'C', 'CB', 'O'], write_pdb=False)
+        if output_filepath is not None:
+            with open(output_filepath, 'w') as fout:
+                fout.write(pdb_string)
+        return pdb_string
+
+def seqdict_key(seqdict):
+    """content hash of chain sequences"""
+    return hashlib.sha1(json.dumps(seqdict, sort_keys=True).encode()).hexdigest()
+
+def file_sha1(filepath):
+    with open(filepath, 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+class RunManifest(object):
+    """
+    Append-only JSON lines record of predicted items (idx, sequence hash, status, model file hash, error).
+    The latest record of an idx wins, so reruns skip valid outputs and reuse models of identical H/L pairs.
+    """
+    def __init__(self, manifest_path) -> None:
+        self.manifest_path = manifest_path
+        self.items = {}
+        # sequence hash -> idxs
+        self.key_idxs = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as fin:
+                for line in fin:
+                    if line.strip():
+                        self._add(json.loads(line))
+    def _add(self, entry):
+        self.items[entry['idx']] = entry
+        self.key_idxs.setdefault(entry['seq_key'], set()).add(entry['idx'])
+    def record(self, idx, seq_key, status, model_path=None, error=None, sha1=None):
+        if sha1 is None and status == 'done':
+            sha1 = file_sha1(model_path)
+        entry = {'idx': str(idx), 'seq_key': seq_key, 'status': status,
+                 'model_path': model_path, 'sha1': sha1,
+                 'error': error}
+        with open(self.manifest_path, 'a') as fout:
+            fout.write(json.dumps(entry) + '\n')
+        self._add(entry)
+    def _valid(self, entry):
+        return (entry['status'] == 'done' and os.path.exists(entry['model_path'])
+                and file_sha1(entry['model_path']) == entry['sha1'])
+    def is_done(self, idx, seq_key):
+        entry = self.items.get(str(idx))
+        return entry is not None and entry['seq_key'] == seq_key and self._valid(entry)
+    def cached_model(self, seq_key):
+        """path of a valid model of the same sequences"""
+        for idx in self.key_idxs.get(seq_key, []):
+            entry = self.items[idx]
+            if entry['seq_key'] == seq_key and self._valid(entry):
+                return entry['model_path']
+    def failed(self):
+        return pd.DataFrame([entry for entry in self.items.values() if entry['status'] == 'failed'],
+                            columns=['idx', 'seq_key', 'status', 'model_path', 'sha1', 'error'])
+
+def plan_items(seqdicts, idxs, output_dir, manifest):
+    """
+    Skips items already done and copies models of identical sequences from earlier runs.
+    Returns items to fold and duplicated items to copy once their sequences are folded.
+    """
+    todo, duplicates, keys_todo = [], [], set()
+    for seqdict, idx in zip(seqdicts, idxs):
+        seq_key = seqdict_key(seqdict)
+        if manifest.is_done(idx, seq_key):
+            continue
+        output_filepath = os.path.join(output_dir, f'{idx}.pdb')
+        cached_path = manifest.cached_model(seq_key)
+        if cached_path is not None:
+            shutil.copyfile(cached_path, output_filepath)
+            manifest.record(idx, seq_key, 'done', output_filepath)
+        elif seq_key in keys_todo:
+            duplicates.append((idx, seq_key))
+        else:
+            keys_todo.add(seq_key)
+            todo.append((seqdict, idx, seq_key))
+    print(f'{len(seqdicts) - len(todo) - len(duplicates)} done or reused, {len(todo)} to fold')
+    return todo, duplicates
+
+def finish_items(duplicates, output_dir, manifest):
+    """copy models to duplicated items and report failures"""
+    for idx, seq_key in duplicates:
+        cached_path = manifest.cached_model(seq_key)
+        if cached_path is not None:
+            output_filepath = os.path.join(output_dir, f'{idx}.pdb')
+            shutil.copyfile(cached_path, output_filepath)
+            manifest.record(idx, seq_key, 'done', output_filepath)
+        else:
+            manifest.record(idx, seq_key, 'failed', error='duplicated item failed')
+    failed = manifest.failed()
+    if len(failed) > 0:
+        print(f'{len(failed)} items failed, see {manifest.manifest_path}')
+    return failed
+
+def open_archive(args):
+    """ModelArchive of args.archive_dir recording written models in its manifest.jsonl"""
+    os.makedirs(args.archive_dir, exist_ok=True)
+    manifest = RunManifest(os.path.join(args.archive_dir, 'manifest.jsonl'))
+    return ModelArchive(args.archive_dir, shard_size=getattr(args, 'shard_size', 1000),
+                        flush_every=getattr(args, 'flush_every', 50),
+                        flush_interval=getattr(args, 'flush_interval', 600), manifest=manifest)
+
+def plan_archive_items(seqdicts, idxs, archive):
+    """
+    plan_items of the archive: skips items archived with the same sequences and
+    copies archived models of identical sequences under their new idx
+    (recorded as done once their shard is written).
+    """
+    todo, duplicates, keys_todo = [], [], set()
+    for seqdict, idx in zip(seqdicts, idxs):
+        seq_key = seqdict_key(seqdict)
+        if archive.has(idx, seq_key):
+            continue
+        cached_idx = archive.find(seq_key)
+        if cached_idx is not None:
+            archive.copy(cached_idx, idx)
+        elif seq_key in keys_todo:
+            duplicates.append((idx, seq_key))
+        else:
+            keys_todo.add(seq_key)
+            todo.append((seqdict, idx, seq_key))
+    print(f'{len(seqdicts) - len(todo) - len(duplicates)} archived or reused, {len(todo)} to fold')
+    return todo, duplicates
+
+def finish_archive_items(duplicates, archive):
+    """copy archived models to duplicated items, flush the archive and report failures"""
+    manifest = archive.manifest
+    for idx, seq_key in duplicates:
+        cached_idx = archive.find(seq_key)
+        if cached_idx is not None:
+            archive.copy(cached_idx, idx)
+        else:
+            manifest.record(idx, seq_key, 'failed', error='duplicated item failed')
+    archive.flush()
+    failed = manifest.failed()
+    if len(failed) > 0:
+        print(f'{len(failed)} items failed, see {manifest.manifest_path}')
+    return failed
+
+def get_output_dir(args):
+    output_dir = args.output_dir if str(args.output_dir).lower() != 'none' else './test_outputs'
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
 def predict_structure(seqdicts, idxs, args, write2file=True, verbose=True):
     # initialize 
     runner = IgFoldRunner(num_models=args.num_models)
     # output dir
-    output_dir = args.output_dir if str(args.output_dir).lower() != 'none' else './test_outputs'
-    os.makedirs(output_dir, exist_ok=True)
+    output_dir = get_output_dir(args)
+    # in memory outputs
+    if not write2file:
+        iter_seqdicts = tqdm(zip(seqdicts, idxs), total=len(seqdicts)) if verbose else zip(seqdicts, idxs)
+        return [fold_one(runner, seqdict, idx, output_dir, args, write2file=False) for seqdict, idx in iter_seqdicts]
+    # archive outputs
+    if getattr(args, 'archive_dir', None) is not None:
+        with open_archive(args) as archive:
+            todo, duplicates = plan_archive_items(seqdicts, idxs, archive)
+            for seqdict, idx, seq_key in tqdm(todo, disable=not verbose):
+                try:
+                    arrays = fold_one(runner, seqdict, idx, output_dir, args, return_arrays=True)
+                except Exception as e:
+                    archive.manifest.record(idx, seq_key, 'failed', error=f'{type(e).__name__}: {e}')
+                    continue
+                archive.add(idx, seqdict, *arrays)
+            return finish_archive_items(duplicates, archive)
     # run
-    output_buffers = []
-    iter_seqdicts = tqdm(zip(seqdicts, idxs), total=len(seqdicts)) if verbose else zip(seqdicts, idxs)
-    for seqdict, idx in iter_seqdicts:
-        output_filepath = os.path.join(output_dir, f'{idx}.pdb')
-        wrong_output = True
-        while wrong_output:
-            try:
-                output = runner.fold(output_filepath, sequences=seqdict, 
-                                    do_refine=args.refine, do_renum=False)
-            except RuntimeError:
-                output = runner.fold(output_filepath, sequences=seqdict, 
-                                    do_refine=False, do_renum=False)
-            except ValueError:
-                print(seqdict)
-                sys.exit()
-            # output 
-            seq = "".join(seqdict.values())
-            chains = list(seqdict.keys())
-            delims = np.cumsum([len(s) for s in seqdict.values()]).tolist()
-            if write2file:
-                save_PDB(output_filepath, output.coords.squeeze(), seq, chains=chains, delim=delims, atoms=['N', 'CA', 'C', 'CB', 'O'])
-                # check output pdb
-                wrong_output = not check_model_seq(output_filepath, ''.join(seqdict.values()))
-            else:
-                pdb_string = save_PDB(None, output.coords.squeeze(), seq, chains=chains, delim=delims, atoms=['N', 'CA', 'C', 'CB', 'O'], write_pdb=False)
-                output_buffer = StringIO(pdb_string)
-                output_buffers.append(output_buffer)
-                wrong_output = False
-    if not write2file: return output_buffers
+    manifest = RunManifest(os.path.join(output_dir, 'manifest.jsonl'))
+    todo, duplicates = plan_items(seqdicts, idxs, output_dir, manifest)
+    for seqdict, idx, seq_key in tqdm(todo, disable=not verbose):
+        try:
+            fold_one(runner, seqdict, idx, output_dir, args)
+            manifest.record(idx, seq_key, 'done', os.path.join(output_dir, f'{idx}.pdb'))
+        except Exception as e:
+            manifest.record(idx, seq_key, 'failed', error=f'{type(e).__name__}: {e}')
+    return finish_items(duplicates, output_dir, manifest)
+
+# model of each worker process
+_worker_runner = None
+
+def _init_worker(num_models, num_threads, refine):
+    global _worker_runner
+    import torch
+    # avoid oversubscription across workers
+    torch.set_num_threads(num_threads)
+    if refine:
+        from igfold.refine.pyrosetta_ref import init_pyrosetta
+        init_pyrosetta()
+    _worker_runner = IgFoldRunner(num_models=num_models)
+
+def _fold_task(task):
+    seqdict, idx, seq_key, output_dir, args = task
+    try:
+        # archived models are written by the main process
+        if getattr(args, 'archive_dir', None) is not None:
+            return idx, seq_key, fold_one(_worker_runner, seqdict, idx, output_dir, args, return_arrays=True), None
+        fold_one(_worker_runner, seqdict, idx, output_dir, args)
+        return idx, seq_key, None, None
+    except (Exception, SystemExit) as e:
+        # a worker must always return its task, otherwise imap_unordered waits forever
+        return idx, seq_key, None, f'{type(e).__name__}: {e}'
+
+def predict_structure_parallel(seqdicts, idxs, args, num_workers=2, threads_per_worker=None, verbose=True):
+    """
+    Folds antibodies in num_workers processes, each loading the model once with threads_per_worker torch threads.
+    Tasks are handed out one at a time from a queue ordered longest first.
+    """
+    threads_per_worker = threads_per_worker if threads_per_worker is not None else max(1, os.cpu_count() // num_workers)
+    output_dir = get_output_dir(args)
+    if getattr(args, 'archive_dir', None) is not None:
+        # buffered models are written even if the result loop fails
+        with open_archive(args) as archive:
+            todo, duplicates = plan_archive_items(seqdicts, idxs, archive)
+            seqdict_dict = {str(idx): seqdict for seqdict, idx, _ in todo}
+            for idx, seq_key, arrays, error in _fold_parallel(todo, output_dir, args, num_workers, threads_per_worker, verbose):
+                if error is None:
+                    archive.add(idx, seqdict_dict[str(idx)], *arrays)
+                else:
+                    archive.manifest.record(idx, seq_key, 'failed', error=error)
+            return finish_archive_items(duplicates, archive)
+    manifest = RunManifest(os.path.join(output_dir, 'manifest.jsonl'))
+    todo, duplicates = plan_items(seqdicts, idxs, output_dir, manifest)
+    for idx, seq_key, _, error in _fold_parallel(todo, output_dir, args, num_workers, threads_per_worker, verbose):
+        if error is None:
+            manifest.record(idx, seq_key, 'done', os.path.join(output_dir, f'{idx}.pdb'))
+        else:
+            manifest.record(idx, seq_key, 'failed', error=error)
+    return finish_items(duplicates, output_dir, manifest)
+
+def _fold_parallel(todo, output_dir, args, num_workers, threads_per_worker, verbose=True):
+    """yields idx, sequence hash, arrays & error of fold tasks as they finish"""
+    # longest first, so that the slowest antibodies do not start last
+    todo = sorted(todo, key=lambda item: sum(len(s) for s in item[0].values()), reverse=True)
+    tasks = [(seqdict, idx, seq_key, output_dir, args) for seqdict, idx, seq_key in todo]
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(num_workers, initializer=_init_worker,
+                  initargs=(args.num_models, threads_per_worker, args.refine)) as pool:
+        yield from tqdm(pool.imap_unordered(_fold_task, tasks, chunksize=1), total=len(tasks), disable=not verbose)
         
 if __name__ == '__main__':
     args = parser_args().parse_args()
-    if args.refine: 
-        from igfold.refine.pyrosetta_ref import init_pyrosetta
-        init_pyrosetta()
     seqdicts, idxs = prepare_inputs(args)
-    predict_structure(seqdicts, idxs, args)
\ No newline at end of file
+    if args.num_workers > 1:
+        predict_structure_parallel(seqdicts, idxs, args, num_workers=args.num_workers,
+                                   threads_per_worker=args.threads_per_worker)
+    else:
+        if args.refine: 
+            from igfold.refine.pyrosetta_ref import init_pyrosetta
+            init_pyrosetta()
+        predict_structure(seqdicts, idxs, args)
@@ -1,6 +1,12 @@
-import subprocess
+import os, subprocess, sqlite3, hashlib, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
+from tqdm import tqdm
+from Bio import SeqIO
+
+RESULT_COLUMNS = ['acc','md5','length','analysis','sig_acc','sig_description',
+                  'start','stop','score','status','date','interpro_acc','interpro_description']
 
 def run_interproscan(exec_path, query_filepath, out_filepath,
                      ncpu=20, applications='SUPERFAMILY,Gene3D,CDD,SMART,Pfam',
@@ -14,35 +20,256 @@ def run_interproscan(exec_path, query_filepath, out_filepath,
                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     return p
 
-def load_result(result_filepath, **kwargs):
-    columns = ['acc','md5','length','analysis','sig_acc','sig_description',
-               'start','stop','score','status','date','interpro_acc','interpro_description']
-    return pd.read_csv(result_filepath, sep='\t', names=columns, **kwargs)
+def seq_md5(seq):
+    """md5 of a sequence as reported in the md5 column of InterProScan"""
+    return hashlib.md5(str(seq).upper().encode()).hexdigest()
 
-def extract_vdomain_result(result, chain='H', dedup=True):
-    filter_masks = []
-    if 'SUPERFAMILY' in result.analysis.values:
-        filter_masks.append((result.sig_acc=='SSF48726') & (result.start<50))
-    if 'Pfam' in result.analysis.values:
-        filter_masks.append(result.sig_acc=='PF07686')
+def fasta_md5(query_filepath):
+    """DataFrame of acc, md5 of the sequences of a FASTA file"""
+    accs, md5s = [], []
+    for rec in SeqIO.parse(query_filepath, 'fasta'):
+        accs.append(rec.id)
+        md5s.append(seq_md5(rec.seq))
+    return pd.DataFrame(data={'acc': accs, 'md5': md5s})
+
+class ResultStore(object):
+    """
+    SQLite store of InterProScan matches keyed by sequence md5.
+    Scanned md5s are recorded with their applications, so sequences without any match are not rescanned.
+    """
+    def __init__(self, db_path) -> None:
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        result_columns = ', '.join(f'{column} TEXT' for column in RESULT_COLUMNS[1:])
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS results ({result_columns})")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_md5 ON results (md5)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scanned (md5 TEXT PRIMARY KEY, applications TEXT, scanned REAL)")
+        self.conn.commit()
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM scanned").fetchone()[0]
+    def scanned(self, md5s, applications=None):
+        """md5s already scanned with (at least) the given comma separated applications"""
+        required = set(applications.split(',')) if applications is not None else set()
+        scanned = set()
+        with self.lock:
+            for md5 in set(md5s):
+                row = self.conn.execute("SELECT applications FROM scanned WHERE md5=?", (md5,)).fetchone()
+                if row is not None and required.issubset(row[0].split(',')):
+                    scanned.add(md5)
+        return scanned
+    def put_tsv(self, tsv_path, md5s, applications, chunksize=100000):
+        """
+        Streams an InterProScan TSV into the store and marks md5s as scanned.
+        Query sequences of the TSV must be named by their seq_md5 (as in shards of run_interproscan_sharded),
+        rows are keyed by that name rather than the md5 column of InterProScan.
+        Previous matches of the md5s are replaced in the same transaction.
+        """
+        md5s = list(set(md5s))
+        n_rows = 0
+        with self.lock:
+            try:
+                self.conn.executemany("DELETE FROM results WHERE md5=?", [(md5,) for md5 in md5s])
+                if os.path.getsize(tsv_path) > 0:
+                    placeholders = ','.join('?' * (len(RESULT_COLUMNS) - 1))
+                    for chunk in pd.read_csv(tsv_path, sep='\t', names=RESULT_COLUMNS, dtype=str,
+                                             keep_default_na=False, chunksize=chunksize):
+                        # key matches by the queried md5
+                        chunk['md5'] = chunk['acc']
+                        rows = chunk.loc[:, RESULT_COLUMNS[1:]].itertuples(index=False, name=None)
+                        self.conn.executemany(f"INSERT INTO results VALUES ({placeholders})", rows)
+                        n_rows += len(chunk)
+                now = time.time()
+                self.conn.executemany("INSERT OR REPLACE INTO scanned VALUES (?,?,?)",
+                                      [(md5, applications, now) for md5 in md5s])
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return n_rows
+    def get_result(self, query_md5):
+        """
+        Matches of query sequences in the load_result format.
+        query_md5: DataFrame with acc & md5 columns (fasta_md5), or dict of acc -> md5
+        """
+        if isinstance(query_md5, dict):
+            query_md5 = pd.DataFrame(data={'acc': list(query_md5.keys()), 'md5': list(query_md5.values())})
+        with self.lock:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS query_md5 (md5 TEXT PRIMARY KEY)")
+            self.conn.execute("DELETE FROM query_md5")
+            self.conn.executemany("INSERT OR IGNORE INTO query_md5 VALUES (?)", [(md5,) for md5 in query_md5.md5])
+            matches = pd.read_sql_query("SELECT results.* FROM results JOIN query_md5 USING (md5)", self.conn)
+            self.conn.execute("DELETE FROM query_md5")
+        result = query_md5.loc[:, ['acc', 'md5']].merge(matches, on='md5').loc[:, RESULT_COLUMNS]
+        result = result.replace('', np.nan)
+        for column in ['length', 'start', 'stop']:
+            result[column] = pd.to_numeric(result[column])
+        return result.reset_index(drop=True)
+    def close(self):
+        self.conn.close()
+
+def _run_interproscan_shard(exec_path, shard_path, ncpu, applications, extra_args):
+    output_prefix = shard_path[:-len('.fa')]
+    cmd = [exec_path, '-i', shard_path, '-o', output_prefix + '.tsv', '-cpu', str(ncpu),
+           '-appl', applications, '-f', 'TSV'] + list(extra_args)
+    start_time = time.time()
+    with open(output_prefix + '.log', 'w') as flog:
+        returncode = subprocess.run(cmd, shell=False, stdout=flog, stderr=subprocess.STDOUT).returncode
+    return returncode, time.time() - start_time
+
+def run_interproscan_sharded(exec_path, query_filepath, output_dir, store,
+                             ncpu=20, n_jobs=4, shard_size=2000,
+                             applications='SUPERFAMILY,Gene3D,CDD,SMART,Pfam', extra_args=[]):
+    """
+    Runs InterProScan on the sequences of query_filepath not yet in the ResultStore.
+    Unscanned sequences are deduplicated by md5, written in shards of shard_size sequences
+    (named by their md5) and run as n_jobs concurrent processes sharing ncpu cpus.
+    Each finished shard TSV is merged into the store, so an interrupted run resumes with the remaining sequences.
+    Returns a DataFrame of shard, n_seqs, status, return code, elapsed time & number of matches.
+    """
+    if isinstance(store, str):
+        store = ResultStore(store)
+    os.makedirs(output_dir, exist_ok=True)
+    seqs = {}
+    for rec in SeqIO.parse(query_filepath, 'fasta'):
+        seqs.setdefault(seq_md5(rec.seq), str(rec.seq).upper())
+    scanned = store.scanned(seqs.keys(), applications)
+    todo_md5s = [md5 for md5 in seqs.keys() if md5 not in scanned]
+    print(f'{len(scanned)} unique sequences scanned, {len(todo_md5s)} to scan')
+    # write shards
+    shards = {}
+    for shard_idx, start_idx in enumerate(range(0, len(todo_md5s), shard_size)):
+        shard_path = os.path.join(output_dir, f'shard_{shard_idx:04d}.fa')
+        shard_md5s = todo_md5s[start_idx:start_idx + shard_size]
+        with open(shard_path, 'w') as fout:
+            for md5 in shard_md5s:
+                fout.write(f'>{md5}\n{seqs[md5]}\n')
+        shards[shard_path] = shard_md5s
+    status = []
+    n_jobs = max(1, min(n_jobs, len(shards)))
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(_run_interproscan_shard, exec_path, shard_path, max(1, ncpu // n_jobs),
+                                   applications, extra_args): shard_path
+                   for shard_path in shards.keys()}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            shard_path = futures[future]
+            n_rows = 0
+            try:
+                returncode, elapsed = future.result()
+                if returncode == 0:
+                    n_rows = store.put_tsv(shard_path[:-len('.fa')] + '.tsv', shards[shard_path], applications)
+                    shard_status = 'done'
+                else:
+                    shard_status = 'failed'
+            except Exception as e:
+                returncode, elapsed, shard_status = None, None, f'{type(e).__name__}: {e}'
+            if shard_status != 'done':
+                print(f'{shard_path} failed ({shard_status if returncode is None else returncode}), '
+                      f'see {shard_path[:-len(".fa")]}.log')
+            status.append((shard_path, len(shards[shard_path]), shard_status, returncode, elapsed, n_rows))
+    status_df = pd.DataFrame(status, columns=['shard', 'n_seqs', 'status', 'returncode', 'elapsed', 'n_matches'])
+    if (status_df.status!='done').any():
+        print(f'{(status_df.status!="done").sum()} of {len(status_df)} shards failed')
+    return status_df
+
+CATEGORY_COLUMNS = ['analysis', 'sig_acc', 'status']
+NUMERIC_COLUMNS = ['length', 'start', 'stop']
+# analysis preferred when deduplicating V-domain matches, others rank last
+VDOMAIN_PRIORITY = {'CDD':1, 'Pfam':2, 'SUPERFAMILY':3}
+
+def _convert_result_chunk(chunk, categorical=True):
+    for column in NUMERIC_COLUMNS:
+        chunk[column] = pd.to_numeric(chunk[column]).astype(np.int32)
+    if categorical:
+        for column in CATEGORY_COLUMNS:
+            chunk[column] = chunk[column].astype('category')
+    return chunk
+
+def _concat_result_chunks(chunks):
+    """concatenates result chunks, unifying categories of categorical columns"""
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    result = pd.concat(chunks, ignore_index=True)
+    for column in CATEGORY_COLUMNS:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            result[column] = pd.api.types.union_categoricals([chunk[column] for chunk in chunks])
+    return result
+
+def iter_result(result_filepath, chunksize=1000000, categorical=True, **kwargs):
+    """Iterates an InterProScan TSV in chunks with categorical analysis/sig_acc/status and numeric length/start/stop"""
+    dtype = {column: str for column in RESULT_COLUMNS if column not in NUMERIC_COLUMNS}
+    for chunk in pd.read_csv(result_filepath, sep='\t', names=RESULT_COLUMNS, dtype=dtype,
+                             chunksize=chunksize, **kwargs):
+        yield _convert_result_chunk(chunk, categorical)
+
+def load_result(result_filepath, chunksize=1000000, categorical=True, **kwargs):
+    """
+    Loads an InterProScan TSV (or a Parquet file of result_to_parquet) chunk by chunk,
+    so only the compact categorical result is held in memory.
+    """
+    if result_filepath.endswith('.parquet'):
+        return _convert_result_chunk(pd.read_parquet(result_filepath, **kwargs), categorical)
+    return _concat_result_chunks(list(iter_result(result_filepath, chunksize, categorical, **kwargs)))
+
+def result_to_parquet(result_filepath, parquet_filepath, chunksize=1000000):
+    """Streams an InterProScan TSV into a Parquet file, requires pyarrow"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    try:
+        for chunk in iter_result(result_filepath, chunksize, categorical=False):
+            for column in NUMERIC_COLUMNS:
+                chunk[column] = chunk[column].astype('int64')
+            if writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                writer = pq.ParquetWriter(parquet_filepath + '.tmp', table.schema)
+            else:
+                table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(parquet_filepath + '.tmp', parquet_filepath)
+
+def _vdomain_mask(result, chain='H'):
+    mask = ((result.sig_acc=='SSF48726') & (result.start<50)).values | (result.sig_acc=='PF07686').values
     if chain == 'H':
-        if 'CDD' in result.analysis.values:
-            filter_masks.append(result.sig_acc=='cd04981')
-        
+        mask |= (result.sig_acc=='cd04981').values
     elif chain == 'L':
-        if 'CDD' in result.analysis.values:
-            filter_masks.append((result.sig_acc=='cd04980') | (result.sig_acc=='cd04984'))
+        mask |= ((result.sig_acc=='cd04980') | (result.sig_acc=='cd04984')).values
     else:
         raise ValueError('chain must be H or L')
-    # filter
-    fileter_mask = np.stack(filter_masks, axis=0).any(0)
-    vdomain_result = result.loc[fileter_mask]
+    return mask
+
+def _dedup_vdomain(vdomain_result):
+    """keeps the match of the preferred analysis per acc"""
+    priority = vdomain_result.analysis.astype(object).map(VDOMAIN_PRIORITY).fillna(100).values
+    order = np.argsort(priority, kind='stable')
+    return vdomain_result.iloc[order].drop_duplicates('acc')
+
+def extract_vdomain_result(result, chain='H', dedup=True):
+    vdomain_result = result.loc[_vdomain_mask(result, chain)]
     if not dedup:
         return vdomain_result
     else:
-        # dedup
-        sort_key = {'CDD':1, 'Pfam':2, 'SUPERFAMILY':3}
-        sort_func = lambda x: sort_key[x] if x in sort_key.keys() else 100
-        sorted_result = vdomain_result.sort_values('analysis', key=np.vectorize(sort_func))
-        dedup_result = sorted_result.drop_duplicates('acc')
-        return dedup_result
\ No newline at end of file
+        return _dedup_vdomain(vdomain_result)
+
+def extract_vdomain_results(result_filepath, chunksize=1000000, dedup=True):
+    """
+    extract_vdomain_result of both chains in one streaming pass over a result file,
+    returns dict of chain -> V-domain matches
+    """
+    if result_filepath.endswith('.parquet'):
+        chunks = [load_result(result_filepath)]
+    else:
+        chunks = iter_result(result_filepath, chunksize)
+    vdomain_chunks = {'H': [], 'L': []}
+    for chunk in chunks:
+        for chain, chain_chunks in vdomain_chunks.items():
+            chain_chunks.append(chunk.loc[_vdomain_mask(chunk, chain)])
+    vdomain_results = {}
+    for chain, chain_chunks in vdomain_chunks.items():
+        vdomain_result = _concat_result_chunks(chain_chunks)
+        vdomain_results[chain] = _dedup_vdomain(vdomain_result) if dedup else vdomain_result
+    return vdomain_results
@@ -1,64 +1,218 @@
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
-import subprocess
+import os, glob, itertools
+import subprocess, sqlite3, hashlib, json, time, string
+import importlib.metadata
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from Bio import SeqIO
 from Bio.Align import PairwiseAligner, substitution_matrices
 from anarci import number
+from .sequence import standardize_seq
 
 def GetRegion(seq):
     standardized = standardize_seq(seq)
-    numbering = GetNumbering(standardized)
+    numbering = _GetStandardizedNumbering(standardized)
     region = MarkRegion(numbering, standardized)
     return ' '.join(map(str, region))
 
-def LoadRegionResult(filename):
+def IterRegionResult(filename, lines=None):
     """
-    Loads the result of the region annotation of AbRSA.
+    Streams the result of the region annotation of AbRSA as one dict per sequence
+    (name, similarity and FR/CDR segments), EXT segments merged into FR1/FR4.
+    Raw lines are appended to lines if a list is given.
     """
+    record = None
     with open(filename, 'r') as f:
-        lines = f.readlines()
-    region_results = []
-    count = 0
-    for line in tqdm(lines):
-        if line.startswith('#'):
-            if line.startswith("#similarity"):
-                similarity = float(line.split(' ')[1].strip())
-                seq_df.loc[seq_name, 'similarity'] = similarity / 100
-            else:
-                continue
-        elif line.startswith('>'):
-            if count > 0:
-                region_results.append(seq_df)
-            seq_name = line[1:].strip()
-            seq_df = pd.DataFrame(index=[seq_name])
-            count += 1
-        elif line.startswith('H') or line.startswith('L') or line.startswith('-'):
-            region = line.split(':')[0].strip()[2:]
-            seq = line.split(':')[1].strip()
-            if region == 'EXT':
-                if 'FR4' in seq_df.columns:
-                    seq_df.loc[seq_name, 'FR4'] = seq_df.loc[seq_name, 'FR4'] + seq
-                else:
-                    seq_df.loc[seq_name, 'FR1'] = seq
-            elif region == 'FR1':
-                if 'FR1' in seq_df.columns:
-                    seq_df.loc[seq_name, 'FR1'] = seq_df.loc[seq_name, 'FR1'] + seq
+        for line in f:
+            if lines is not None:
+                lines.append(line)
+            if line.startswith('#'):
+                if line.startswith("#similarity"):
+                    record['similarity'] = float(line.split(' ')[1].strip()) / 100
+            elif line.startswith('>'):
+                if record is not None:
+                    yield record
+                record = {'name': line[1:].strip()}
+            elif line.startswith('H') or line.startswith('L') or line.startswith('-'):
+                region = line.split(':')[0].strip()[2:]
+                seq = line.split(':')[1].strip()
+                if region == 'EXT':
+                    if 'FR4' in record:
+                        record['FR4'] = record['FR4'] + seq
+                    else:
+                        record['FR1'] = seq
+                elif region == 'FR1':
+                    record['FR1'] = record.get('FR1', '') + seq
                 else:
-                    seq_df.loc[seq_name, 'FR1'] = seq
-            else:
-                seq_df.loc[seq_name, region] = seq
-        else:
-            continue
+                    record[region] = seq
     # for final sequence
-    region_results.append(seq_df)
-    return pd.concat(region_results), lines
+    if record is not None:
+        yield record
+
+def _RegionRecordsToFrame(records):
+    if len(records) == 0:
+        return pd.DataFrame()
+    region_df = pd.DataFrame.from_records(records, index='name')
+    region_df.index.name = None
+    return region_df
+
+def IterRegionResultChunks(filename, chunksize=100000):
+    """
+    Loads the result of the region annotation of AbRSA in DataFrames of chunksize sequences.
+    """
+    records = []
+    for record in IterRegionResult(filename):
+        records.append(record)
+        if len(records) == chunksize:
+            yield _RegionRecordsToFrame(records)
+            records = []
+    if len(records) > 0:
+        yield _RegionRecordsToFrame(records)
 
-def RunANARCI(input_file, output_file):
+def LoadRegionResult(filename, keep_lines=False):
+    """
+    Loads the result of the region annotation of AbRSA.
+    Returns the region DataFrame and the raw lines (None unless keep_lines).
+    """
+    lines = [] if keep_lines else None
+    records = list(tqdm(IterRegionResult(filename, lines=lines)))
+    return _RegionRecordsToFrame(records), lines
+
+ANARCI_ENV = {'PATH':'/anaconda/envs/bindpredict/bin:/anaconda/condabin'}
+
+def RunANARCI(input_file, output_file, exec_path='ANARCI', env=ANARCI_ENV):
     """
     Runs ANARCI on the input file.
     """
-    cmd = ['ANARCI', '-i', input_file, '-o', output_file, '--csv']
-    subprocess.run(cmd, env={'PATH':'/anaconda/envs/bindpredict/bin:/anaconda/condabin'})
+    cmd = [exec_path, '-i', input_file, '-o', output_file, '--csv']
+    return subprocess.run(cmd, env=env)
+
+def SplitFasta(input_file, output_dir, n_shards):
+    """Splits a FASTA file into n_shards contiguous shards, returns shard paths."""
+    with open(input_file) as fin:
+        n_records = sum(1 for line in fin if line.startswith('>'))
+    split_points = np.linspace(0, n_records, n_shards + 1, dtype=int)
+    shard_paths = [os.path.join(output_dir, f'shard_{idx:04d}.fa') for idx in range(n_shards)]
+    records = SeqIO.parse(input_file, 'fasta')
+    for shard_path, start_idx, stop_idx in zip(shard_paths, split_points[:-1], split_points[1:]):
+        SeqIO.write(itertools.islice(records, stop_idx - start_idx), shard_path + '.tmp', 'fasta')
+        os.replace(shard_path + '.tmp', shard_path)
+    return shard_paths
+
+def _RunANARCIShard(shard_path, exec_path, env, extra_args):
+    output_prefix = shard_path[:-len('.fa')]
+    cmd = [exec_path, '-i', shard_path, '-o', output_prefix, '--csv'] + list(extra_args)
+    start_time = time.time()
+    with open(output_prefix + '.log', 'w') as flog:
+        returncode = subprocess.run(cmd, env=env, stdout=flog, stderr=subprocess.STDOUT).returncode
+    if returncode == 0:
+        # mark finished shard
+        open(output_prefix + '.done', 'w').close()
+    return returncode, time.time() - start_time
+
+SHARD_MANIFEST = 'shards.json'
+
+def _FileSha1(fpath, blocksize=2**20):
+    sha1 = hashlib.sha1()
+    with open(fpath, 'rb') as fin:
+        for block in iter(lambda: fin.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def _LoadShardManifest(output_dir):
+    manifest_path = os.path.join(output_dir, SHARD_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as fin:
+        return json.load(fin)
+
+def _ClearShards(output_dir):
+    """removes shards, outputs & markers of a previous split"""
+    for fpath in glob.glob(os.path.join(output_dir, 'shard_*')):
+        os.remove(fpath)
+    manifest_path = os.path.join(output_dir, SHARD_MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+def RunANARCISharded(input_file, output_dir, n_shards=8, n_jobs=None, exec_path='ANARCI', env=None, extra_args=[]):
+    """
+    Runs ANARCI on n_shards shards of the input FASTA file with n_jobs processes in parallel.
+    Finished shards are marked with a .done file and skipped when the run is resumed.
+    The split is recorded in a manifest with n_shards & the input checksum, any change
+    (or a missing shard) clears the previous shards and outputs before splitting again.
+    env defaults to the current environment.
+    Returns a DataFrame of shard, status, return code, elapsed time & error of shards that raised.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    input_sha1 = _FileSha1(input_file)
+    manifest = _LoadShardManifest(output_dir)
+    shard_paths = [os.path.join(output_dir, f'shard_{idx:04d}.fa') for idx in range(n_shards)]
+    if manifest is None or manifest['n_shards'] != n_shards or manifest['input_sha1'] != input_sha1 \
+            or not all(os.path.exists(shard_path) for shard_path in shard_paths):
+        _ClearShards(output_dir)
+        shard_paths = SplitFasta(input_file, output_dir, n_shards)
+        manifest = {'input_file': os.path.abspath(input_file), 'input_sha1': input_sha1, 'n_shards': n_shards,
+                    'shards': [os.path.basename(shard_path) for shard_path in shard_paths]}
+        with open(os.path.join(output_dir, SHARD_MANIFEST + '.tmp'), 'w') as fout:
+            json.dump(manifest, fout)
+        os.replace(os.path.join(output_dir, SHARD_MANIFEST + '.tmp'), os.path.join(output_dir, SHARD_MANIFEST))
+    todo_paths = [shard_path for shard_path in shard_paths if not os.path.exists(shard_path[:-len('.fa')] + '.done')]
+    print(f'{len(shard_paths) - len(todo_paths)} shards done, {len(todo_paths)} to run')
+    status = {shard_path: ('done', 0, 0.0, None) for shard_path in shard_paths}
+    with ThreadPoolExecutor(max_workers=n_jobs if n_jobs is not None else n_shards) as executor:
+        futures = {executor.submit(_RunANARCIShard, shard_path, exec_path, env, extra_args): shard_path
+                   for shard_path in todo_paths}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                returncode, elapsed = future.result()
+                status[futures[future]] = ('done' if returncode == 0 else 'failed', returncode, elapsed, None)
+            except Exception as e:
+                status[futures[future]] = ('failed', None, None, f'{type(e).__name__}: {e}')
+    status_df = pd.DataFrame([(shard_path,) + shard_status for shard_path, shard_status in status.items()],
+                             columns=['shard', 'status', 'returncode', 'elapsed', 'error'])
+    if (status_df.status=='failed').any():
+        print(f'{(status_df.status=="failed").sum()} shards failed')
+    return status_df
+
+def _MergeColumnOrder(column_lists):
+    """union of ordered column lists, keeping the relative order within each list"""
+    merged = []
+    for columns in column_lists:
+        insert_idx = 0
+        for column in columns:
+            if column in merged:
+                insert_idx = merged.index(column) + 1
+            else:
+                merged.insert(insert_idx, column)
+                insert_idx += 1
+    return merged
+
+def MergeNumbering(output_dir, chain='H', chunksize=10000, return_ids=False):
+    """
+    Merges the per-shard ANARCI CSVs of RunANARCISharded (chain: H or KL) into the masked numbering
+    array of LoadNumbering, reading in chunks and aligning numbering columns across shards.
+    Only the shards listed in the manifest of the last split are merged.
+    """
+    manifest = _LoadShardManifest(output_dir)
+    if manifest is None:
+        raise FileNotFoundError(f'no {SHARD_MANIFEST} in {output_dir}, run RunANARCISharded first')
+    csv_paths = [os.path.join(output_dir, f'{shard[:-len(".fa")]}_{chain}.csv') for shard in manifest['shards']]
+    csv_paths = [csv_path for csv_path in csv_paths if os.path.exists(csv_path)]
+    column_lists = [list(pd.read_csv(csv_path, nrows=0).columns[13:]) for csv_path in csv_paths]
+    numbers = np.array(_MergeColumnOrder(column_lists), dtype=object)
+    masked_chunks, ids = [], []
+    for csv_path in csv_paths:
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=str, keep_default_na=False):
+            ids.extend(chunk.iloc[:, 0])
+            seqs_arr = chunk.iloc[:, 13:].reindex(columns=numbers, fill_value='-').to_numpy(dtype=object)
+            # mask out gaps
+            masked_chunks.append(np.where(seqs_arr!='-', numbers[None, :], seqs_arr))
+    masked = np.concatenate(masked_chunks) if len(masked_chunks) > 0 else np.empty((0, len(numbers)), dtype=object)
+    if return_ids:
+        return masked, ids
+    return masked
 
 def LoadNumbering(output_file):
     result = pd.read_csv(output_file)
@@ -78,21 +232,21 @@ class SeqNumbering(object):
     def __len__(self):
         return len(self.numbering)
 
-def standardize_seq(seq, standard_aa_str="ARNDCQEGHILKMFPSTWYV"):
-    # upper
-    seq = seq.upper()
-    # only standard aa
-    standard_aas = list(standard_aa_str)
-    seq_list = list(seq)
-    for idx, aa in enumerate(seq_list):
-        if aa not in standard_aas:
-            seq_list[idx] = 'A'
-    return ''.join(seq_list)
+@lru_cache(maxsize=None)
+def _GetAligner():
+    """aligner of ANARCI output to the sequence, built once per process"""
+    aligner = PairwiseAligner()
+    aligner.substitution_matrix = substitution_matrices.load("BLOSUM90")
+    aligner.internal_open_gap_score = -10
+    return aligner
 
 def GetNumbering(seq, scheme='IMGT'):
     """Gets the numbering of the sequence."""
     # process unknown amino acids
     seq = standardize_seq(seq)
+    return _GetStandardizedNumbering(seq, scheme)
+
+def _GetStandardizedNumbering(seq, scheme='IMGT'):
     # use ANARCI to get the numbering
     results = number(seq, scheme=scheme)[0]
     if not results:
@@ -107,12 +261,7 @@ def GetNumbering(seq, scheme='IMGT'):
     label = label[valid_mask]
     anarci_seq = anarci_seq[valid_mask]
     # align to the original sequence
-    # setup the aligner
-    aligner = PairwiseAligner()
-    aligner.substitution_matrix = substitution_matrices.load("BLOSUM90")
-    aligner.internal_open_gap_score = -10
-    # align
-    aln = aligner.align(''.join(anarci_seq), seq)[0]
+    aln = _GetAligner().align(''.join(anarci_seq), seq)[0]
     anarci_start, anarci_stop = aln.aligned[0][0]
     seq_start, seq_stop = aln.aligned[1][0]
     # subset result
@@ -123,6 +272,108 @@ def GetNumbering(seq, scheme='IMGT'):
     numbering_result = ['-'] * seq_start + numbering_result + ['-'] * (len(seq) - seq_stop)
     return numbering_result
 
+def GetNumberingBatch(seqs, scheme='IMGT', n_jobs=1, chunksize=16, cache=None):
+    """
+    Gets the numbering of many sequences, in input order.
+    Standardized sequences are numbered once each, spread over n_jobs processes.
+    With a NumberingCache only sequences not cached are numbered.
+    """
+    standardized = [standardize_seq(seq) for seq in seqs]
+    results = _NumberStandardizedBatch(list(dict.fromkeys(standardized)), scheme, n_jobs, chunksize, cache)
+    return [results[seq][0] for seq in standardized]
+
+def GetRegionBatch(seqs, n_jobs=1, chunksize=16, cache=None):
+    """Gets the encoded IMGT region strings of many sequences, as GetRegion, in input order."""
+    standardized = [standardize_seq(seq) for seq in seqs]
+    results = _NumberStandardizedBatch(list(dict.fromkeys(standardized)), 'IMGT', n_jobs, chunksize, cache)
+    return [results[seq][1] for seq in standardized]
+
+def _NumberStandardizedBatch(unique_seqs, scheme, n_jobs, chunksize, cache):
+    """standardized sequence -> (numbering, region string)"""
+    results = cache.get_many(unique_seqs, scheme) if cache is not None else {}
+    missing_seqs = [seq for seq in unique_seqs if seq not in results]
+    number_func = partial(_GetStandardizedNumbering, scheme=scheme)
+    if n_jobs > 1 and len(missing_seqs) > chunksize:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            numberings = list(tqdm(executor.map(number_func, missing_seqs, chunksize=chunksize), total=len(missing_seqs)))
+    else:
+        numberings = [number_func(seq) for seq in tqdm(missing_seqs)]
+    # region marking follows IMGT numbering
+    new_results = {seq: (numbering, _RegionString(numbering) if scheme.upper() == 'IMGT' else None)
+                   for seq, numbering in zip(missing_seqs, numberings)}
+    if cache is not None:
+        cache.put_many(new_results, scheme)
+    results.update(new_results)
+    return results
+
+def _RegionString(numbering):
+    if numbering is None:
+        return None
+    return ' '.join(map(str, MarkRegion(numbering)))
+
+def _AnarciVersion():
+    try:
+        return importlib.metadata.version('anarci')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+class NumberingCache(object):
+    """
+    SQLite cache of numbering and encoded region string,
+    keyed by hash of (standardized sequence, scheme, ANARCI version).
+    Least recently used entries are evicted beyond max_entries.
+    """
+    def __init__(self, db_path, max_entries=None, anarci_version=None) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.anarci_version = anarci_version if anarci_version is not None else _AnarciVersion()
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS numbering (key TEXT PRIMARY KEY, numbering TEXT, region TEXT, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS numbering_accessed ON numbering (accessed)")
+        self.conn.commit()
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM numbering").fetchone()[0]
+    def make_key(self, seq, scheme='IMGT'):
+        return hashlib.sha1(f'{self.anarci_version}\t{scheme.upper()}\t{seq}'.encode()).hexdigest()
+    def get_many(self, seqs, scheme='IMGT', batch_size=500):
+        """standardized sequence -> (numbering, region string) of cached sequences"""
+        key_seqs = {self.make_key(seq, scheme): seq for seq in seqs}
+        keys = list(key_seqs.keys())
+        results = {}
+        for startidx in range(0, len(keys), batch_size):
+            batch_keys = keys[startidx:startidx + batch_size]
+            placeholders = ','.join(['?'] * len(batch_keys))
+            rows = self.conn.execute(f"SELECT key, numbering, region FROM numbering WHERE key IN ({placeholders})", batch_keys)
+            for key, numbering, region in rows:
+                results[key_seqs[key]] = (json.loads(numbering), region)
+        # update access time of hits
+        now = time.time()
+        self.conn.executemany("UPDATE numbering SET accessed=? WHERE key=?",
+                              [(now, self.make_key(seq, scheme)) for seq in results])
+        self.conn.commit()
+        return results
+    def put_many(self, results, scheme='IMGT'):
+        """insert standardized sequence -> (numbering, region string)"""
+        now = time.time()
+        rows = [(self.make_key(seq, scheme), json.dumps(numbering), region, now)
+                for seq, (numbering, region) in results.items()]
+        self.conn.executemany("INSERT OR REPLACE INTO numbering VALUES (?,?,?,?)", rows)
+        if self.max_entries is not None:
+            # evict the least recently used entries beyond max_entries
+            n_over = len(self) - self.max_entries
+            if n_over > 0:
+                self.conn.execute("DELETE FROM numbering WHERE key IN (SELECT key FROM numbering ORDER BY accessed ASC LIMIT ?)",
+                                  (n_over,))
+        self.conn.commit()
+    def get_regions(self, seqs):
+        """raw sequence -> region string of cached sequences"""
+        standardized = {seq: standardize_seq(seq) for seq in seqs}
+        results = self.get_many(set(standardized.values()), 'IMGT')
+        return {seq: results[std_seq][1] for seq, std_seq in standardized.items()
+                if std_seq in results and results[std_seq][1] is not None}
+    def close(self):
+        self.conn.close()
+
 def MarkRegion(numbering, encode=True):
     """
     Mark regions according to IMGT numbering.
@@ -151,28 +402,75 @@ def MarkRegion(numbering, encode=True):
             else:
                 region.append('FR4')
     if encode:
-        encode_dict = {'-':0, 'FR1':1, 'CDR1':2, 'FR2':3, 'CDR2':4, 'FR3':5, 'CDR3':6, 'FR4':7}
-        region = [encode_dict[r] for r in region]
+        region = [REGION_CODES[r] for r in region]
     return region
 
-def ReindexNumberingIdxs(numbering_idxs):
+REGION_CODES = {'-':0, 'FR1':1, 'CDR1':2, 'FR2':3, 'CDR2':4, 'FR3':5, 'CDR3':6, 'FR4':7}
+
+# last position of FR1, CDR1, FR2, CDR2, FR3 & CDR3 for each (scheme, chain), FR4 follows
+REGION_BOUNDARIES = {
+    ('IMGT', 'H'): [26, 38, 55, 65, 104, 117],
+    ('IMGT', 'L'): [26, 38, 55, 65, 104, 117],
+    ('KABAT', 'H'): [30, 35, 49, 65, 94, 102],
+    ('KABAT', 'L'): [23, 34, 49, 56, 88, 97],
+    ('CHOTHIA', 'H'): [25, 32, 51, 56, 94, 102],
+    ('CHOTHIA', 'L'): [23, 34, 49, 56, 88, 97],
+}
+
+def PadNumbering(numberings, pad='-'):
+    """Pads ragged numbering lists (None for failed numbering) into a 2D array."""
+    max_len = max([len(n) for n in numberings if n is not None], default=0)
+    padded = np.full((len(numberings), max_len), pad, dtype=object)
+    for idx, numbering in enumerate(numberings):
+        if numbering is not None:
+            padded[idx, :len(numbering)] = numbering
+    return padded
+
+def NumberingPositions(numbering_arr):
     """
-    Reindex the numbering indexes.
+    Integer positions of numbering strings (insertion letters dropped), -1 for gaps.
+    Strings are parsed once per unique value and mapped back by index.
     """
+    numbering_arr = np.asarray(numbering_arr).astype(str)
+    uniques, inverse = np.unique(numbering_arr, return_inverse=True)
+    positions = np.array([int(u.rstrip(string.ascii_letters)) if u[:1].isdigit() else -1 for u in uniques], dtype=np.int32)
+    return positions[inverse].reshape(numbering_arr.shape)
+
+def MarkRegionArray(numbering_arr, scheme='IMGT', chain='H'):
+    """
+    Vectorized MarkRegion over a whole dataset, e.g. the output of LoadNumbering
+    or ragged numbering lists (padded with gaps).
+    Returns int8 region codes (see REGION_CODES) from boundaries of the scheme & chain.
+    """
+    if not isinstance(numbering_arr, np.ndarray):
+        numbering_arr = PadNumbering(numbering_arr)
+    positions = NumberingPositions(numbering_arr)
+    boundaries = np.asarray(REGION_BOUNDARIES[(scheme.upper(), chain)])
+    codes = (np.searchsorted(boundaries, positions, side='left') + 1).astype(np.int8)
+    codes[positions < 0] = REGION_CODES['-']
+    return codes
+
+def _NumberingSortKey(idx):
     # add "A" to the end of the numbering if it not ends with a letter
-    numbering_idxs = [idx + 'A' if not idx[-1].isalpha() else idx for idx in numbering_idxs]
+    idx = idx + 'A' if not idx[-1].isalpha() else idx
     # fill to the beginning of the numbering with "0"
-    numbering_idxs = [idx.zfill(4) for idx in numbering_idxs]
-    # sort and get the reverse index
-    numbering_idxs = np.array(numbering_idxs)
-    sort_idxs = np.argsort(numbering_idxs)
-    sorted_numbering_idxs = numbering_idxs[sort_idxs]
-    # remove duplicates
-    dedup_numbering_idxs = np.unique(sorted_numbering_idxs)
-    # reindex the numbering with 0,1,2,3...
-    new_idxs = np.arange(len(dedup_numbering_idxs))
-    # reindex the original numbering
-    reindex = dict(zip(dedup_numbering_idxs, new_idxs))
-    reindexed_numbering_idxs = [reindex[idx] for idx in numbering_idxs]
-    return reindexed_numbering_idxs
+    return idx.zfill(4)
+
+def ReindexNumberingArray(numbering_idxs):
+    """
+    Vectorized ReindexNumberingIdxs over an array of any shape,
+    returns integer column indices of the numbering indexes.
+    """
+    numbering_idxs = np.asarray(numbering_idxs).astype(str)
+    uniques, inverse = np.unique(numbering_idxs, return_inverse=True)
+    # rank of each unique sort key
+    sort_keys = np.array([_NumberingSortKey(u) for u in uniques])
+    _, key_inverse = np.unique(sort_keys, return_inverse=True)
+    return key_inverse[inverse.reshape(-1)].reshape(numbering_idxs.shape)
+
+def ReindexNumberingIdxs(numbering_idxs):
+    """
+    Reindex the numbering indexes.
+    """
+    return ReindexNumberingArray(numbering_idxs).tolist()
     
\ No newline at end of file
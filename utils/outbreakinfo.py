@@ -1,9 +1,13 @@
+import os, hashlib
 import pandas as pd
 import numpy as np
+from functools import lru_cache
 from Bio.Align import PairwiseAligner, substitution_matrices
+from .sequence import encode_seq, encode_padded
 
 rbd_wt_seq = "RVQPTESIVRFPNITNLCPFGEVFNATRFASVYAWNRKRISNCVADYSVLYNSASFSTFKCYGVSPTKLNDLCFTNVYADSFVIRGDEVRQIAPGQTGKIADYNYKLPDDFTGCVIAWNSNNLDSKVGGNYNYLYRLFRKSNLKPFERDISTEIYQAGSTPCNGVEGFNCYFPLQSYGFQPTNGVGYQPYRVVVLSFELLHAPATVCGPKKSTNLVKNKCVNF"
 rbd_wt_seqarr = np.asarray(list(rbd_wt_seq))
+rbd_wt_seqcodes = encode_seq(rbd_wt_seq)
 rbd_wt_resids = np.arange(319,542)
 
 def load_variant_rbdseq_table(seqtable_filepath):
@@ -13,25 +17,121 @@ def load_variant_rbdseq_table(seqtable_filepath):
     variant_rbdseq.loc[length_table, 'rbd_seq'] = rbd_wt_seq
     return variant_rbdseq
 
-def get_aln_score(query_seq, target_seq):
-    # aligner
+@lru_cache(maxsize=None)
+def get_aligner():
+    """BLOSUM90 aligner shared by all alignments"""
     aligner = PairwiseAligner()
     aligner.substitution_matrix = substitution_matrices.load('BLOSUM90')
+    return aligner
+
+def get_aln_score(query_seq, target_seq):
     # aln
-    aln = aligner.align(query_seq, target_seq)
+    aln = get_aligner().align(query_seq, target_seq)
     return aln, aln.score
 
 def identify_lineage(variant_rbdseq_table, query_rbdseq, 
                      rbdseq_colname='rbd_seq', lineage_colname='lineage'):
-    # aligner
-    aligner = PairwiseAligner()
-    aligner.substitution_matrix = substitution_matrices.load('BLOSUM90')
-    
     # alignment
-    alns = [aligner.align(query_rbdseq, rbdseq) for rbdseq in variant_rbdseq_table[rbdseq_colname].values]
-    aln_scores = np.asarray([aln.score for aln in alns])
+    aligner = get_aligner()
+    aln_scores = np.asarray([aligner.score(query_rbdseq, rbdseq) for rbdseq in variant_rbdseq_table[rbdseq_colname].values])
     
     # lineage with highest score
     matched_lineages = variant_rbdseq_table[lineage_colname].values[np.argmax(aln_scores)]
     
-    return matched_lineages
\ No newline at end of file
+    return matched_lineages
+
+def identify_lineages_batch(variant_rbdseq_table, queries,
+                            rbdseq_colname='rbd_seq', lineage_colname='lineage', chunksize=256):
+    """
+    Identifies lineages of many query RBD sequences, in three tiers:
+    exact sequence lookup; Hamming distance against the uint8 matrix of variants spanning rbd_wt_resids
+    for queries of the same length; alignment with the shared aligner for queries with indels.
+    Returns a DataFrame of query, best lineage, all tied lineages, method, mismatches (exact & hamming)
+    and aln_score (align).
+    """
+    variant_seqs = variant_rbdseq_table[rbdseq_colname].values.astype(str)
+    lineages = variant_rbdseq_table[lineage_colname].values
+    # exact lookup
+    seq_lineages = {}
+    for seq, lineage in zip(variant_seqs, lineages):
+        seq_lineages.setdefault(seq, []).append(lineage)
+    # variant matrix over rbd_wt_resids
+    full_mask = np.array([len(seq) == len(rbd_wt_resids) for seq in variant_seqs], dtype=bool)
+    variant_mat = encode_padded(variant_seqs[full_mask], length=len(rbd_wt_resids))
+    full_lineages = lineages[full_mask]
+    
+    unique_queries = list(dict.fromkeys(queries))
+    results = {}
+    hamming_queries, align_queries = [], []
+    for query in unique_queries:
+        if query in seq_lineages:
+            results[query] = (seq_lineages[query], 'exact', 0, np.nan)
+        elif len(query) == len(rbd_wt_resids) and len(variant_mat) > 0:
+            hamming_queries.append(query)
+        else:
+            align_queries.append(query)
+    # hamming distance in chunks of queries
+    for startidx in range(0, len(hamming_queries), chunksize):
+        chunk_queries = hamming_queries[startidx:startidx + chunksize]
+        query_mat = encode_padded(chunk_queries, length=len(rbd_wt_resids))
+        mismatches = (query_mat[:, None, :] != variant_mat[None, :, :]).sum(-1)
+        best_mismatches = mismatches.min(1)
+        for query, query_mismatches, best in zip(chunk_queries, mismatches, best_mismatches):
+            results[query] = (list(full_lineages[query_mismatches == best]), 'hamming', int(best), np.nan)
+    # alignment for queries with indels
+    aligner = get_aligner()
+    for query in align_queries:
+        aln_scores = np.asarray([aligner.score(query, seq) for seq in variant_seqs])
+        best = aln_scores.max()
+        results[query] = (list(lineages[aln_scores == best]), 'align', np.nan, float(best))
+    
+    rows = [(query, results[query][0][0], results[query][0]) + results[query][1:] for query in queries]
+    return pd.DataFrame(rows, columns=['query', 'lineage', 'ties', 'method', 'mismatches', 'aln_score'])
+
+def get_mutated_positions(rbdseq):
+    """bool mask over rbd_wt_resids of positions mutated, deleted or followed by an insertion"""
+    if len(rbdseq) == len(rbd_wt_seq):
+        return encode_seq(rbdseq) != rbd_wt_seqcodes
+    mutated = np.ones(len(rbd_wt_seq), dtype=bool)
+    aln = get_aligner().align(rbd_wt_seq, rbdseq)[0]
+    wt_blocks, query_blocks = aln.aligned
+    prev_query_end = None
+    for (wt_start, wt_end), (query_start, query_end) in zip(wt_blocks, query_blocks):
+        mutated[wt_start:wt_end] = encode_seq(rbdseq[query_start:query_end]) != rbd_wt_seqcodes[wt_start:wt_end]
+        # insertion before this block
+        if prev_query_end is not None and query_start > prev_query_end and wt_start > 0:
+            mutated[wt_start - 1] = True
+        prev_query_end = query_end
+    return mutated
+
+def build_mutation_bitmap(variant_rbdseq_table, rbdseq_colname='rbd_seq', lineage_colname='lineage'):
+    """lineages and lineage x RBD position (319-541) bitmap of mutated positions"""
+    lineages = np.asarray(variant_rbdseq_table[lineage_colname], dtype=str)
+    bitmap = np.stack([get_mutated_positions(seq) for seq in variant_rbdseq_table[rbdseq_colname].values]) \
+        if len(lineages) > 0 else np.zeros((0, len(rbd_wt_resids)), dtype=bool)
+    return lineages, bitmap
+
+def load_mutation_bitmap(variant_rbdseq_table, cache_filepath, rbdseq_colname='rbd_seq', lineage_colname='lineage'):
+    """build_mutation_bitmap cached in a npz file, recomputed only when the variant table changes"""
+    table_hash = hashlib.sha1(pd.util.hash_pandas_object(
+        variant_rbdseq_table[[lineage_colname, rbdseq_colname]], index=False).values.tobytes()).hexdigest()
+    if os.path.exists(cache_filepath):
+        with np.load(cache_filepath) as cached:
+            if str(cached['table_hash']) == table_hash:
+                return cached['lineages'], cached['bitmap']
+    lineages, bitmap = build_mutation_bitmap(variant_rbdseq_table, rbdseq_colname, lineage_colname)
+    with open(cache_filepath, 'wb') as fout:
+        np.savez_compressed(fout, lineages=lineages, bitmap=bitmap, table_hash=np.array(table_hash))
+    return lineages, bitmap
+
+def escape_overlap(mutation_bitmap, contact_bitmap):
+    """lineage x antibody counts of contact positions mutated in each lineage"""
+    return mutation_bitmap.astype(np.int32) @ contact_bitmap.astype(np.int32).T
+
+def escaping_lineages(lineages, mutation_bitmap, contact_bitmap, ab_ids, min_overlap=1):
+    """long table of (lineage, antibody, number of mutated contact positions) with at least min_overlap"""
+    overlap = escape_overlap(mutation_bitmap, contact_bitmap)
+    lineage_idxs, ab_idxs = np.nonzero(overlap >= min_overlap)
+    return pd.DataFrame(data={'lineage': np.asarray(lineages)[lineage_idxs],
+                              'ab_id': np.asarray(ab_ids)[ab_idxs],
+                              'n_overlap': overlap[lineage_idxs, ab_idxs]})
@@ -1,65 +1,262 @@
-import requests, json
+import requests, json, time, asyncio, sqlite3, hashlib, threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import pandas as pd
 
-def retrieve_entity_id(pdbcode):
-    baseurl = "https://data.rcsb.org/graphql?query="
-    pdbcode = pdbcode.upper()
-    query = "{entries(entry_ids:[\""+pdbcode+"\"]){rcsb_entry_container_identifiers{entity_ids}}}"
-    url = baseurl + query
-    r = requests.get(url)
-    result = json.loads(r.text)
+GRAPHQL_URL = "https://data.rcsb.org/graphql"
+
+class RCSBError(Exception):
+    """base error of RCSB queries"""
+
+class RCSBRequestError(RCSBError):
+    """HTTP request failed after retries"""
+    def __init__(self, message, status_code=None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+class RCSBQueryError(RCSBError):
+    """GraphQL query returned errors"""
+
+class RCSBNotFoundError(RCSBError):
+    """queried id not found"""
+
+class RCSBOfflineError(RCSBError):
+    """query not cached in offline mode"""
+
+class ResponseCache(object):
+    """
+    SQLite cache of GraphQL responses keyed by normalized query and variables,
+    with TTL expiry, size-bounded LRU eviction and hit/miss counters.
+    In offline mode queries are served only from the cache.
+    """
+    def __init__(self, db_path, ttl=None, max_entries=None, offline=False) -> None:
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, query TEXT, data TEXT, created REAL, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+    @staticmethod
+    def make_key(query, variables=None):
+        normalized = json.dumps({'query': ' '.join(query.split()), 'variables': variables}, sort_keys=True)
+        return hashlib.sha1(normalized.encode()).hexdigest()
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    def get(self, query, variables=None):
+        """cached data or None"""
+        key = self.make_key(query, variables)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT data, created FROM responses WHERE key=?", (key,)).fetchone()
+            # expired entries count as misses unless offline
+            if row is None or (self.ttl is not None and not self.offline and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET accessed=? WHERE key=?", (now, key))
+            self.conn.commit()
+        return json.loads(row[0])
+    def put(self, query, variables, data):
+        key = self.make_key(query, variables)
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?)",
+                              (key, ' '.join(query.split()), json.dumps(data), now, now))
+            if self.max_entries is not None:
+                self._evict()
+            self.conn.commit()
+    def _evict(self):
+        """delete least recently used entries beyond max_entries"""
+        n_over = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if n_over > 0:
+            self.conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed ASC LIMIT ?)",
+                              (n_over,))
+    def prune(self):
+        """remove expired entries and entries beyond max_entries"""
+        with self.lock:
+            if self.ttl is not None:
+                self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            if self.max_entries is not None:
+                self._evict()
+            self.conn.commit()
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+    def close(self):
+        self.conn.close()
+
+# field name -> (root, id argument, selection, path to value)
+QUERY_FIELDS = {
+    'entity_id': ('entries', 'entry_ids', 'rcsb_entry_container_identifiers{entity_ids}',
+                  ['rcsb_entry_container_identifiers', 'entity_ids']),
+    'instance_id': ('polymer_entities', 'entity_ids', 'rcsb_polymer_entity_container_identifiers{asym_ids}',
+                    ['rcsb_polymer_entity_container_identifiers', 'asym_ids']),
+    'entity_annotation': ('polymer_entities', 'entity_ids', 'rcsb_polymer_entity_annotation{annotation_id,name,type}',
+                          ['rcsb_polymer_entity_annotation']),
+    'auth_instance_id': ('polymer_entity_instances', 'instance_ids', 'rcsb_polymer_entity_instance_container_identifiers{auth_asym_id}',
+                         ['rcsb_polymer_entity_instance_container_identifiers', 'auth_asym_id']),
+    'instance_annotation': ('polymer_entity_instances', 'instance_ids', 'rcsb_polymer_instance_annotation{annotation_id,name,type}',
+                            ['rcsb_polymer_instance_annotation']),
+    'sequence': ('polymer_entities', 'entity_ids', 'entity_poly{pdbx_seq_one_letter_code_can}',
+                 ['entity_poly', 'pdbx_seq_one_letter_code_can']),
+    'sequence_raw': ('polymer_entities', 'entity_ids', 'entity_poly{pdbx_seq_one_letter_code}',
+                     ['entity_poly', 'pdbx_seq_one_letter_code']),
+    'entity_description': ('polymer_entities', 'entity_ids', 'rcsb_polymer_entity{pdbx_description}',
+                           ['rcsb_polymer_entity', 'pdbx_description']),
+    'entry_title': ('entries', 'entry_ids', 'struct{title}', ['struct', 'title']),
+}
+
+def build_field_query(field):
+    root, id_arg, selection, _ = QUERY_FIELDS[field]
+    return "query($ids:[String!]!){" + root + "(" + id_arg + ":$ids){" + selection + "}}"
+
+def extract_field(data, field, query_id):
+    root, _, _, path = QUERY_FIELDS[field]
+    items = data.get(root) or []
+    if len(items) == 0 or items[0] is None:
+        raise RCSBNotFoundError(f'{query_id} not found')
+    value = items[0]
+    for key in path:
+        if value is None:
+            return None
+        value = value[key]
+    return value
+
+class RCSBClient(object):
+    """
+    GraphQL client of RCSB data API with pooled keep-alive connections,
+    timeout and retry with exponential backoff on connection errors, 429 and 5xx.
+    Responses are served from and stored to the optional ResponseCache.
+    """
+    def __init__(self, url=GRAPHQL_URL, timeout=30, max_tries=5, backoff=0.5, pool_size=10, cache=None) -> None:
+        if max_tries < 1:
+            raise ValueError('max_tries must be at least 1')
+        self.url = url
+        self.cache = cache
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    def query(self, query, variables=None):
+        """run query and return its data"""
+        if self.cache is not None:
+            data = self.cache.get(query, variables)
+            if data is not None:
+                return data
+            if self.cache.offline:
+                raise RCSBOfflineError('query not cached')
+        data = self._post(query, variables)
+        if self.cache is not None:
+            self.cache.put(query, variables, data)
+        return data
+    def _post(self, query, variables=None):
+        for attempt in range(self.max_tries):
+            try:
+                r = self.session.post(self.url, json={'query': query, 'variables': variables}, timeout=self.timeout)
+                if r.status_code == 200:
+                    result = r.json()
+            except requests.JSONDecodeError as e:
+                # undecodable (e.g. truncated) responses are retried
+                error = RCSBRequestError(f'invalid JSON response: {e}', r.status_code)
+            except requests.RequestException as e:
+                error = RCSBRequestError(str(e))
+            else:
+                if r.status_code == 429 or r.status_code >= 500:
+                    error = RCSBRequestError(f'HTTP {r.status_code}', r.status_code)
+                elif r.status_code != 200:
+                    raise RCSBRequestError(f'HTTP {r.status_code}: {r.text[:200]}', r.status_code)
+                else:
+                    if result.get('errors'):
+                        raise RCSBQueryError(result['errors'])
+                    return result['data']
+            if attempt < self.max_tries - 1:
+                time.sleep(self.backoff * 2 ** attempt)
+        raise error
+    def retrieve(self, field, query_id):
+        """retrieve one field of an entry, entity or instance id"""
+        query_id = query_id.upper()
+        data = self.query(build_field_query(field), {'ids': [query_id]})
+        return extract_field(data, field, query_id)
+    def retrieve_many(self, field, query_ids, n_workers=8):
+        """retrieve one field of many ids in parallel, errors are returned in place"""
+        def retrieve_or_error(query_id):
+            try:
+                return self.retrieve(field, query_id)
+            except RCSBError as e:
+                return e
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(retrieve_or_error, query_ids))
+    def close(self):
+        self.session.close()
+
+class AsyncRCSBClient(object):
+    """asyncio variant of RCSBClient with a concurrency limit"""
+    def __init__(self, client=None, concurrency=8) -> None:
+        self.client = client if client is not None else RCSBClient(pool_size=concurrency)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+    async def query(self, query, variables=None):
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(self.client.query, query, variables))
+    async def retrieve(self, field, query_id):
+        query_id = query_id.upper()
+        data = await self.query(build_field_query(field), {'ids': [query_id]})
+        return extract_field(data, field, query_id)
+    async def retrieve_many(self, field, query_ids):
+        """retrieve one field of many ids, errors are returned in place"""
+        return await asyncio.gather(*[self.retrieve(field, query_id) for query_id in query_ids], return_exceptions=True)
+    def close(self):
+        self.executor.shutdown()
+
+# shared client used by retrieve_* functions
+_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = RCSBClient()
+    return _client
+
+def set_client(client):
+    global _client
+    _client = client
+
+def enable_cache(db_path, ttl=None, max_entries=None, offline=False):
+    """attach a persistent response cache to the shared client"""
+    cache = ResponseCache(db_path, ttl=ttl, max_entries=max_entries, offline=offline)
+    get_client().cache = cache
+    return cache
+
+def _retrieve(field, query_id):
     try:
-        return result['data']['entries'][0]['rcsb_entry_container_identifiers']['entity_ids']
-    except:
-        return result
+        return get_client().retrieve(field, query_id)
+    except RCSBError as e:
+        return e
+
+def retrieve_entity_id(pdbcode):
+    return _retrieve('entity_id', pdbcode)
 
 def retrieve_instance_id(entity_id):
-    baseurl = "https://data.rcsb.org/graphql?query="
-    entity_id = entity_id.upper()
-    query = "{polymer_entities(entity_ids:[\""+entity_id+"\"]){rcsb_polymer_entity_container_identifiers{asym_ids}}}"
-    url = baseurl + query
-    r = requests.get(url)
-    result = json.loads(r.text)
-    try:
-        return result['data']['polymer_entities'][0]['rcsb_polymer_entity_container_identifiers']['asym_ids']
-    except:
-        return result
+    return _retrieve('instance_id', entity_id)
 
 def retrieve_entity_annotation(entity_id):
-    baseurl = "https://data.rcsb.org/graphql?query="
-    entity_id = entity_id.upper()
-    query = "{polymer_entities(entity_ids:[\""+entity_id+"\"]){rcsb_polymer_entity_annotation{annotation_id,name,type}}}"
-    url = baseurl + query
-    r = requests.get(url)
-    result = json.loads(r.text)
-    try:
-        return result['data']['polymer_entities'][0]['rcsb_polymer_entity_annotation']
-    except:
-        return result
+    return _retrieve('entity_annotation', entity_id)
 
 def retrieve_auth_instance_id(instance_id):
-    baseurl = "https://data.rcsb.org/graphql?query="
-    instance_id = instance_id.upper()
-    query = "{polymer_entity_instances(instance_ids:[\""+instance_id+"\"]){rcsb_polymer_entity_instance_container_identifiers{auth_asym_id}}}"
-    url = baseurl + query
-    r = requests.get(url)
-    result = json.loads(r.text)
-    try:
-        return result['data']['polymer_entity_instances'][0]['rcsb_polymer_entity_instance_container_identifiers']['auth_asym_id']
-    except:
-        return result
+    return _retrieve('auth_instance_id', instance_id)
     
 def retrieve_instance_annotation(instance_id):
-    baseurl = "https://data.rcsb.org/graphql?query="
-    instance_id = instance_id.upper()
-    query = "{polymer_entity_instances(instance_ids:[\""+instance_id+"\"]){rcsb_polymer_instance_annotation{annotation_id,name,type}}}"
-    url = baseurl + query
-    r = requests.get(url)
-    result = json.loads(r.text)
-    try:
-        return result['data']['polymer_entity_instances'][0]['rcsb_polymer_instance_annotation']
-    except:
-        return result
+    return _retrieve('instance_annotation', instance_id)
     
 def build_idmapping(pdbcode):
     pdbcode = pdbcode.upper()
@@ -82,45 +279,78 @@ def build_idmapping(pdbcode):
         print(f'{pdbcode} not found')
         return None
     
+IDMAPPING_QUERY = """
+query($entry_ids: [String!]!) {
+  entries(entry_ids: $entry_ids) {
+    rcsb_id
+    struct { title }
+    polymer_entities {
+      rcsb_polymer_entity_container_identifiers { entity_id asym_ids }
+      rcsb_polymer_entity { pdbx_description }
+      rcsb_polymer_entity_annotation { annotation_id name type }
+      entity_poly { pdbx_seq_one_letter_code_can }
+      polymer_entity_instances {
+        rcsb_polymer_entity_instance_container_identifiers { asym_id auth_asym_id }
+        rcsb_polymer_instance_annotation { annotation_id name type }
+      }
+    }
+  }
+}
+"""
+
+def _entry_idmapping(entry):
+    """flatten one nested entry into instance rows"""
+    rows = []
+    pdbcode = entry['rcsb_id']
+    title = (entry.get('struct') or {}).get('title')
+    for entity in entry.get('polymer_entities') or []:
+        entity_ids = entity['rcsb_polymer_entity_container_identifiers']
+        instances = {}
+        for instance in entity.get('polymer_entity_instances') or []:
+            instance_ids = instance['rcsb_polymer_entity_instance_container_identifiers']
+            instances[instance_ids['asym_id']] = (instance_ids['auth_asym_id'], instance['rcsb_polymer_instance_annotation'])
+        for instance_id in entity_ids['asym_ids']:
+            auth_instance_id, instance_annotation = instances.get(instance_id, (None, None))
+            rows.append({'pdbcode': pdbcode, 'entity_id': entity_ids['entity_id'], 'instance_id': instance_id,
+                         'auth_instance_id': auth_instance_id,
+                         'entity_description': (entity.get('rcsb_polymer_entity') or {}).get('pdbx_description'),
+                         'entity_annotation': entity.get('rcsb_polymer_entity_annotation'),
+                         'instance_annotation': instance_annotation,
+                         'sequence': (entity.get('entity_poly') or {}).get('pdbx_seq_one_letter_code_can'),
+                         'title': title})
+    return rows
+
+def build_idmapping_many(pdbcodes, batch_size=200):
+    """
+    Build idmapping of many entries with batched nested GraphQL queries,
+    including entity description & annotation, instance annotation, canonical sequence and entry title.
+    """
+    pdbcodes = list(dict.fromkeys(pdbcode.upper() for pdbcode in pdbcodes))
+    rows = []
+    found = set()
+    for startidx in range(0, len(pdbcodes), batch_size):
+        batch_codes = pdbcodes[startidx:startidx + batch_size]
+        entries = get_client().query(IDMAPPING_QUERY, {'entry_ids': batch_codes}).get('entries') or []
+        for entry in entries:
+            if entry is None:
+                continue
+            found.add(entry['rcsb_id'])
+            rows.extend(_entry_idmapping(entry))
+    for pdbcode in pdbcodes:
+        if pdbcode not in found:
+            print(f'{pdbcode} not found')
+    columns = ['pdbcode', 'entity_id', 'instance_id', 'auth_instance_id', 'entity_description',
+               'entity_annotation', 'instance_annotation', 'sequence', 'title']
+    return pd.DataFrame(rows, columns=columns)
+
 def retrieve_sequence(entity_id,  canonical=True):
-    baseurl = "https://data.rcsb.org/graphql?query="
-    entity_id = entity_id.upper()
-    if canonical:
-        key_name = 'pdbx_seq_one_letter_code_can'
-    else:
-        key_name = 'pdbx_seq_one_letter_code'
-    query = "{polymer_entities(entity_ids:[\""+entity_id+"\"]){entity_poly{"+key_name+"}}}"
-    url = baseurl + query
-    r = requests.get(url)
-    result = json.loads(r.text)
-    try:
-        return result['data']['polymer_entities'][0]['entity_poly'][key_name]
-    except:
-        return result
+    return _retrieve('sequence' if canonical else 'sequence_raw', entity_id)
     
 def retrieve_entity_description(entity_id):
-    baseurl = "https://data.rcsb.org/graphql?query="
-    entity_id = entity_id.upper()
-    query = "{polymer_entities(entity_ids:[\""+entity_id+"\"]){rcsb_polymer_entity{pdbx_description}}}"
-    url = baseurl + query
-    r = requests.get(url)
-    result = json.loads(r.text)
-    try:
-        return result['data']['polymer_entities'][0]['rcsb_polymer_entity']['pdbx_description']
-    except:
-        return result
+    return _retrieve('entity_description', entity_id)
     
 def retrieve_entry_title(pdbcode):
-    baseurl = "https://data.rcsb.org/graphql?query="
-    pdbcode = pdbcode.upper()
-    query = "{entries(entry_ids:[\""+pdbcode+"\"]){struct{title}}}"
-    url = baseurl + query
-    r = requests.get(url)
-    result = json.loads(r.text)
-    try:
-        return result['data']['entries'][0]['struct']['title']
-    except:
-        return result
+    return _retrieve('entry_title', pdbcode)
     
 def generate_dllink(pdbcode, format='cif', zipped=False):
     pdbcode = pdbcode.upper()
@@ -14,55 +14,116 @@ def remove_duplicated_record(record_table, sortdict=None):
     
     return rmdup_record
 
+def _collect_seqs(seqtable, seq_cols):
+    """unique sequences of each column labeled with the chain of the column (Hseq -> H)"""
+    current_seqs = pd.concat([seqtable[col].drop_duplicates().to_frame('seq').assign(chain=col[0])
+                              for col in sorted(seq_cols)], ignore_index=True) # Hseq first, then Lseq
+    return current_seqs.dropna(subset=['seq'])
+
+def _seq_mapping(table, value_col):
+    """seq -> value of a lookup table, the last row of duplicated seqs wins"""
+    table = table.dropna(subset=[value_col]).drop_duplicates('seq', keep='last')
+    return pd.Series(table[value_col].values, index=table['seq'].values)
+
 def truncate2fv(seqtable, trunct2fv_table, seq_cols=['Hseq','Lseq']):
-    # make collection if sequences in seqtable
-    seq_cols = sorted(seq_cols) # Hseq first, then Lseq
-    current_seqs = pd.concat([seqtable[col] for col in seq_cols]).reset_index(drop=True).to_frame('seq')
-    current_seqs.loc[:len(current_seqs)//2, 'chain'] = 'H'
-    current_seqs.loc[len(current_seqs)//2:, 'chain'] = 'L'
-    current_seqs = current_seqs.drop_duplicates('seq')
-    
     # only long sequences need truncation
-    current_seqs = current_seqs.loc[current_seqs.seq.apply(len)>150].reset_index(drop=True)
-    
-    # merge table
-    merged_result = pd.merge(current_seqs, trunct2fv_table, on='seq', how='left')
+    current_seqs = _collect_seqs(seqtable, seq_cols)
+    current_seqs = current_seqs.loc[current_seqs.seq.str.len()>150]
+    mapping = _seq_mapping(trunct2fv_table, 'seq_vdomain')
     
     # seqs not in db
-    notinclued_seqs = merged_result.loc[merged_result.seq_vdomain.isna(), ['seq','chain']].copy()
+    notinclued_seqs = current_seqs.loc[~current_seqs.seq.isin(mapping.index)].drop_duplicates('seq').reset_index(drop=True)
     
     # others continue to be truncated
-    merged_result.dropna(subset=['seq_vdomain'], inplace=True)
     output_seqtable = seqtable.copy()
-    for idx, row in merged_result.iterrows():
-        if row['chain'] == 'H':
-            output_seqtable.loc[output_seqtable.Hseq==row['seq'], 'Hseq'] = row['seq_vdomain']
-        elif row['chain'] == 'L':
-            output_seqtable.loc[output_seqtable.Lseq==row['seq'], 'Lseq'] = row['seq_vdomain']
+    for col in seq_cols:
+        long_mask = output_seqtable[col].str.len()>150
+        truncated = output_seqtable.loc[long_mask, col].map(mapping)
+        output_seqtable.loc[long_mask, col] = truncated.fillna(output_seqtable.loc[long_mask, col])
     
     return output_seqtable, notinclued_seqs
 
-def add_region_label(seqtable, region_table, seq_cols=['Hseq','Lseq']):
-    # make collection if sequences in seqtable
-    seq_cols = sorted(seq_cols) # Hseq first, then Lseq
-    current_seqs = pd.concat([seqtable[col] for col in seq_cols]).reset_index(drop=True).to_frame('seq')
-    current_seqs.loc[:len(current_seqs)//2, 'chain'] = 'H'
-    current_seqs.loc[len(current_seqs)//2:, 'chain'] = 'L'
-    current_seqs = current_seqs.drop_duplicates('seq')
+def add_region_label(seqtable, region_table, seq_cols=['Hseq','Lseq'], cache=None, number_missing=False, n_jobs=1):
+    current_seqs = _collect_seqs(seqtable, seq_cols)
+    mapping = _seq_mapping(region_table, 'region')
     
-    # merge table
-    merged_result = pd.merge(current_seqs, region_table, on='seq', how='left')
+    # fill from numbering cache, optionally numbering the rest
+    if cache is not None:
+        missing_seqs = current_seqs.loc[~current_seqs.seq.isin(mapping.index), 'seq'].drop_duplicates().tolist()
+        mapping = pd.concat([mapping, _fill_regions(missing_seqs, cache, number_missing, n_jobs)])
     
     # seqs not in db
-    notinclued_seqs = merged_result.loc[merged_result.region.isna(), ['seq','chain']].copy()
+    notinclued_seqs = current_seqs.loc[~current_seqs.seq.isin(mapping.index)].drop_duplicates('seq').reset_index(drop=True)
     
-    # others continue to be truncated
-    merged_result.dropna(subset=['region'], inplace=True)
+    # others get labeled
     output_seqtable = seqtable.copy()
-    for idx, row in merged_result.iterrows():
-        if row['chain'] == 'H':
-            output_seqtable.loc[output_seqtable.Hseq==row['seq'], 'Hregion'] = row['region']
-        elif row['chain'] == 'L':
-            output_seqtable.loc[output_seqtable.Lseq==row['seq'], 'Lregion'] = row['region']
+    for col in seq_cols:
+        region_col = f'{col[0]}region'
+        regions = output_seqtable[col].map(mapping)
+        output_seqtable[region_col] = regions.fillna(output_seqtable[region_col]) \
+            if region_col in output_seqtable.columns else regions
     
-    return output_seqtable, notinclued_seqs
\ No newline at end of file
+    return output_seqtable, notinclued_seqs
+
+def _fill_regions(missing_seqs, cache, number_missing=False, n_jobs=1):
+    """seq -> region of sequences missing from the region table, from the numbering cache"""
+    if number_missing:
+        from .numbering import GetRegionBatch
+        regions = dict(zip(missing_seqs, GetRegionBatch(missing_seqs, n_jobs=n_jobs, cache=cache)))
+    else:
+        regions = cache.get_regions(missing_seqs)
+    return pd.Series(regions, dtype=object).dropna()
+
+def _ensure_seq_index(conn, table_name):
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "{table_name}_seq" ON "{table_name}" (seq)')
+    conn.commit()
+
+def _sql_lookup(conn, seqtable_name, lookup_table_name, seq_cols, value_col, output_cols, min_len=None):
+    """
+    Looks up value_col of each seq column in an indexed lookup table inside SQLite.
+    output_cols: column the looked up value of each seq column is written to
+    (the seq column itself keeps its value when nothing is found)
+    """
+    _ensure_seq_index(conn, lookup_table_name)
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{seqtable_name}")')]
+    len_cond = lambda col: f'length(s."{col}")>{min_len} AND ' if min_len is not None else ''
+    lookup = lambda col: (f'(SELECT t."{value_col}" FROM "{lookup_table_name}" t '
+                          f'WHERE t.seq=s."{col}" AND t."{value_col}" IS NOT NULL ORDER BY t.rowid DESC LIMIT 1)')
+    select = {col: f's."{col}"' for col in columns}
+    for col, output_col in zip(seq_cols, output_cols):
+        if output_col == col:
+            select[col] = f'COALESCE({lookup(col)}, s."{col}")'
+            if min_len is not None:
+                select[col] = f'CASE WHEN length(s."{col}")>{min_len} THEN {select[col]} ELSE s."{col}" END'
+        else:
+            fallback = f's."{output_col}"' if output_col in columns else 'NULL'
+            select[output_col] = f'COALESCE({lookup(col)}, {fallback})'
+    select_sql = ', '.join(f'{expr} AS "{col}"' for col, expr in select.items())
+    output_seqtable = pd.read_sql_query(f'SELECT {select_sql} FROM "{seqtable_name}" s', conn)
+    
+    # seqs not in db
+    missing_sql = ' UNION ALL '.join(
+        f'SELECT DISTINCT s."{col}" AS seq, \'{col[0]}\' AS chain FROM "{seqtable_name}" s '
+        f'WHERE {len_cond(col)}s."{col}" IS NOT NULL AND NOT EXISTS '
+        f'(SELECT 1 FROM "{lookup_table_name}" t WHERE t.seq=s."{col}" AND t."{value_col}" IS NOT NULL)'
+        for col in sorted(seq_cols)) # Hseq first, then Lseq
+    notinclued_seqs = pd.read_sql_query(missing_sql, conn).drop_duplicates('seq').reset_index(drop=True)
+    return output_seqtable, notinclued_seqs
+
+def truncate2fv_sql(conn, seqtable_name, trunct2fv_table_name, seq_cols=['Hseq','Lseq']):
+    """truncate2fv joining tables of the database inside SQLite, the lookup table is indexed on seq"""
+    return _sql_lookup(conn, seqtable_name, trunct2fv_table_name, seq_cols, 'seq_vdomain', seq_cols, min_len=150)
+
+def add_region_label_sql(conn, seqtable_name, region_table_name, seq_cols=['Hseq','Lseq'], cache=None, number_missing=False, n_jobs=1):
+    """add_region_label joining tables of the database inside SQLite, the region table is indexed on seq"""
+    region_cols = [f'{col[0]}region' for col in seq_cols]
+    output_seqtable, notinclued_seqs = _sql_lookup(conn, seqtable_name, region_table_name, seq_cols, 'region', region_cols)
+    
+    # fill from numbering cache, optionally numbering the rest
+    if cache is not None and len(notinclued_seqs) > 0:
+        regions = _fill_regions(notinclued_seqs.seq.tolist(), cache, number_missing, n_jobs)
+        for col, region_col in zip(seq_cols, region_cols):
+            output_seqtable[region_col] = output_seqtable[region_col].fillna(output_seqtable[col].map(regions))
+        notinclued_seqs = notinclued_seqs.loc[~notinclued_seqs.seq.isin(regions.index)].reset_index(drop=True)
+    
+    return output_seqtable, notinclued_seqs
@@ -0,0 +1,64 @@
+import numpy as np
+from functools import lru_cache
+
+STANDARD_AAS = "ARNDCQEGHILKMFPSTWYV"
+
+@lru_cache(maxsize=None)
+def _standardize_table(standard_aa_str=STANDARD_AAS, unknown='A'):
+    """byte translation table keeping standard amino acids, others to unknown"""
+    table = bytearray(unknown.encode('ascii') * 256)
+    for aa in standard_aa_str.encode('ascii'):
+        table[aa] = aa
+    return bytes(table)
+
+def standardize_seq(seq, standard_aa_str=STANDARD_AAS, unknown='A'):
+    """upper case and replace non-standard amino acids with unknown"""
+    # non-ascii characters become '?' and then unknown
+    seq = seq.upper().encode('ascii', 'replace')
+    return seq.translate(_standardize_table(standard_aa_str, unknown)).decode('ascii')
+
+def standardize_seqs(seqs, standard_aa_str=STANDARD_AAS, unknown='A'):
+    return [standardize_seq(seq, standard_aa_str, unknown) for seq in seqs]
+
+def encode_seq(seq):
+    """uint8 array of ascii codes of a sequence"""
+    return np.frombuffer(seq.encode('ascii', 'replace'), dtype=np.uint8)
+
+def decode_seq(codes):
+    return np.asarray(codes, dtype=np.uint8).tobytes().decode('ascii')
+
+def encode_seqs(seqs):
+    """
+    Encodes sequences into a ragged uint8 buffer,
+    sequence i spans buffer[offsets[i]:offsets[i+1]]
+    """
+    encoded = [seq.encode('ascii', 'replace') for seq in seqs]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(seq) for seq in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def decode_seqs(buffer, offsets):
+    data = np.asarray(buffer, dtype=np.uint8).tobytes()
+    return [data[start:stop].decode('ascii') for start, stop in zip(offsets[:-1], offsets[1:])]
+
+def standardize_encoded(buffer, standard_aa_str=STANDARD_AAS, unknown='A'):
+    """standardize_seq on an encoded buffer (upper case applied to ascii letters)"""
+    lut = np.frombuffer(_standardize_table(standard_aa_str, unknown), dtype=np.uint8).copy()
+    # lower case letters map as their upper case
+    lower = np.arange(ord('a'), ord('z') + 1)
+    lut[lower] = lut[lower - 32]
+    return lut[np.asarray(buffer, dtype=np.uint8)]
+
+def encode_padded(seqs, length=None, pad='-'):
+    """
+    Encodes sequences into a (n_seqs, length) uint8 matrix padded with pad,
+    length defaults to the longest sequence and longer sequences are truncated
+    """
+    buffer, offsets = encode_seqs(seqs)
+    lengths = np.diff(offsets)
+    length = int(lengths.max(initial=0)) if length is None else length
+    padded = np.full((len(lengths), length), ord(pad), dtype=np.uint8)
+    cols = np.arange(length)
+    mask = cols[None, :] < np.minimum(lengths, length)[:, None]
+    padded[mask] = buffer[(offsets[:-1, None] + cols[None, :])[mask]]
+    return padded
@@ -1,10 +1,25 @@
+import os, glob, gzip, time, sqlite3
+from functools import lru_cache
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 import numpy as np
+import pandas as pd
+import requests
 from esm.inverse_folding.util import filter_backbone, get_chains
 from biotite.structure.io import pdbx, pdb
 import biotite.database.rcsb as rcsb
+import biotite.structure as struc
 from tempfile import gettempdir
 import gemmi
 from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+from .pdbinfo import generate_dllink
+
+# number of parsed structures kept in memory
+STRUCTURE_CACHE_SIZE = 16
+# author residue ids of RBD
+RBD_RESIDS = np.arange(319, 542)
 
 def get_ca_cras(pdb_file):
     """get cra of CA atoms"""
@@ -43,10 +58,77 @@ def get_cras_chain(cras, labeltype='auth'):
         raise ValueError('chaintype must be auth or label')
     return chains
 
-def calc_distance_matrix(pos):
-    """calculate distance matrix"""
-    return np.sqrt(np.sum((pos[:, None, :] - pos[None, :, :])**2, axis=-1))
+# columnar CA atoms of a structure
+CAArrays = namedtuple('CAArrays', ['pos', 'resid', 'label_seq', 'chain', 'subchain', 'seq'])
+
+def get_ca_arrays(pdb_file):
+    """
+    Single pass extraction of CA atoms of the first model as struct-of-arrays:
+    float32 positions, auth & label residue numbers, auth & label chains and one-letter sequence.
+    The first conformer of each residue's CA is used.
+    """
+    structure = gemmi.read_structure(pdb_file) if isinstance(pdb_file, str) else pdb_file
+    structure.setup_entities()
+    model = structure[0]
+    pos, resid, label_seq, chain, subchain, resnames = [], [], [], [], [], []
+    for ch in model:
+        for res in ch:
+            atom = res.find_atom('CA', '*')
+            if atom is None:
+                continue
+            pos.append((atom.pos.x, atom.pos.y, atom.pos.z))
+            resid.append(res.seqid.num)
+            label_seq.append(res.label_seq if res.label_seq is not None else -1)
+            chain.append(ch.name)
+            subchain.append(res.subchain)
+            resnames.append(res.name)
+    return CAArrays(pos=np.asarray(pos, dtype=np.float32).reshape(-1, 3),
+                    resid=np.asarray(resid, dtype=np.int32),
+                    label_seq=np.asarray(label_seq, dtype=np.int32),
+                    chain=np.asarray(chain),
+                    subchain=np.asarray(subchain),
+                    seq=gemmi.one_letter_code(resnames))
+
+def calc_distance_matrix(pos, other=None, dtype=np.float64, max_memory=2**28):
+    """
+    calculate distance matrix between pos and other (pos itself if None),
+    computed in row blocks so intermediates stay below max_memory bytes
+    """
+    other = pos if other is None else other
+    dist = np.empty((len(pos), len(other)), dtype=dtype)
+    for startidx, block in iter_distance_blocks(pos, other, dtype=dtype, max_memory=max_memory):
+        dist[startidx:startidx + len(block)] = block
+    return dist
+
+def iter_distance_blocks(pos, other, dtype=np.float32, max_memory=2**28):
+    """yield (start row, distance block) with blocks of at most max_memory bytes"""
+    pos = np.asarray(pos, dtype=dtype)
+    other = np.asarray(other, dtype=dtype)
+    # cdist works in float64
+    block_size = max(1, max_memory // (max(len(other), 1) * 8))
+    for startidx in range(0, len(pos), block_size):
+        yield startidx, cdist(pos[startidx:startidx + block_size], other).astype(dtype, copy=False)
+
+def find_neighbors(pos, radius, other=None):
+    """
+    sparse pairs (i, j, distance) within radius between pos and other (pos itself if None, i < j),
+    found with KD-trees without building the full distance matrix
+    """
+    tree = cKDTree(pos)
+    if other is None:
+        pairs = tree.query_pairs(radius, output_type='ndarray')
+        pos = np.asarray(pos, dtype=np.float32)
+        dist = np.linalg.norm(pos[pairs[:, 0]] - pos[pairs[:, 1]], axis=-1)
+        return pairs[:, 0], pairs[:, 1], dist
+    pairs = tree.sparse_distance_matrix(cKDTree(other), radius, output_type='ndarray')
+    return pairs['i'], pairs['j'], pairs['v'].astype(np.float32)
+
 
+def open_text(fpath):
+    """open plain or gzipped text file"""
+    if fpath.endswith('.gz'):
+        return gzip.open(fpath, 'rt')
+    return open(fpath)
 
 def load_structure(fpath, chain=None, use_author_chain=False, backbone=True, extra_fields=[]):
     """
@@ -56,13 +138,14 @@ def load_structure(fpath, chain=None, use_author_chain=False, backbone=True, ext
     Returns:
         biotite.structure.AtomArray
     """
-    if fpath.endswith('cif'):
-        with open(fpath) as fin:
+    fname = fpath[:-3] if fpath.endswith('.gz') else fpath
+    if fname.endswith('cif'):
+        with open_text(fpath) as fin:
             pdbxf = pdbx.PDBxFile.read(fin)
         structure = pdbx.get_structure(pdbxf, model=1, use_author_fields=use_author_chain,
                                        extra_fields=extra_fields)
-    elif fpath.endswith('pdb'):
-        with open(fpath) as fin:
+    elif fname.endswith('pdb'):
+        with open_text(fpath) as fin:
             pdbf = pdb.PDBFile.read(fin)
         structure = pdb.get_structure(pdbf, model=1,
                                       extra_fields=extra_fields)
@@ -84,40 +167,250 @@ def load_structure(fpath, chain=None, use_author_chain=False, backbone=True, ext
     structure = structure[chain_filter]
     return structure
 
-def fetch_structure(pdbcode, load=True, format='mmcif', **kwargs):
-    pdb_filepath = rcsb.fetch(pdbcode, format, gettempdir())
+class StructureMirror(object):
+    """
+    Local mirror of gzipped mmCIF files keyed by PDB ID and revision,
+    stored as {root}/{pdbcode[1:3]}/{pdbcode}_{major}.{minor}.cif.gz
+    """
+    def __init__(self, root, offline=False) -> None:
+        self.root = root
+        self.offline = offline
+    def _entry_dir(self, pdbcode):
+        return os.path.join(self.root, pdbcode[1:3].lower())
+    def revisions(self, pdbcode):
+        """locally stored revisions, oldest first"""
+        pdbcode = pdbcode.upper()
+        revisions = []
+        for fpath in glob.glob(os.path.join(self._entry_dir(pdbcode), f'{pdbcode}_*.cif.gz')):
+            major, minor = os.path.basename(fpath)[len(pdbcode) + 1:-len('.cif.gz')].split('.')
+            revisions.append((int(major), int(minor)))
+        return sorted(revisions)
+    def path(self, pdbcode, revision=None):
+        """path of the given or latest local revision, None if not mirrored"""
+        pdbcode = pdbcode.upper()
+        if revision is None:
+            revisions = self.revisions(pdbcode)
+            if len(revisions) == 0:
+                return None
+            revision = revisions[-1]
+        fpath = os.path.join(self._entry_dir(pdbcode), f'{pdbcode}_{revision[0]}.{revision[1]}.cif.gz')
+        return fpath if os.path.exists(fpath) else None
+    def fetch(self, pdbcode, update=False):
+        """path of the latest local revision, downloaded if missing or update"""
+        pdbcode = pdbcode.upper()
+        fpath = self.path(pdbcode)
+        if fpath is not None and not update:
+            return fpath
+        if self.offline:
+            if fpath is None:
+                raise FileNotFoundError(f'{pdbcode} not in structure mirror')
+            return fpath
+        r = requests.get(generate_dllink(pdbcode, format='cif', zipped=True), timeout=120)
+        r.raise_for_status()
+        major, minor = read_cif_revision(gzip.decompress(r.content).decode())
+        fpath = os.path.join(self._entry_dir(pdbcode), f'{pdbcode}_{major}.{minor}.cif.gz')
+        if not os.path.exists(fpath):
+            os.makedirs(self._entry_dir(pdbcode), exist_ok=True)
+            # write atomically for concurrent workers
+            tmp_fpath = f'{fpath}.{os.getpid()}.tmp'
+            with open(tmp_fpath, 'wb') as fout:
+                fout.write(r.content)
+            os.replace(tmp_fpath, fpath)
+        return fpath
+
+def read_cif_revision(cif_text):
+    """latest (major, minor) revision in mmCIF text"""
+    block = gemmi.cif.read_string(cif_text).sole_block()
+    table = block.find('_pdbx_audit_revision_history.', ['major_revision', 'minor_revision'])
+    revisions = [(int(row[0]), int(row[1])) for row in table]
+    return max(revisions) if len(revisions) > 0 else (0, 0)
+
+def fetch_structure(pdbcode, load=True, format='mmcif', mirror=None, **kwargs):
+    if mirror is not None:
+        pdb_filepath = mirror.fetch(pdbcode)
+    else:
+        pdb_filepath = rcsb.fetch(pdbcode, format, gettempdir())
     if not load:
         return pdb_filepath
     else:
         return load_structure(pdb_filepath, **kwargs)
-    
-def detect_rbd_contacts_matrix(ab_instance_ids, rbd_instance_id, threshold=8):
+
+@lru_cache(maxsize=STRUCTURE_CACHE_SIZE)
+def _load_complex_file(fpath):
+    with open_text(fpath) as fin:
+        pdbxf = pdbx.PDBxFile.read(fin)
+    structure = pdbx.get_structure(pdbxf, model=1, use_author_fields=False, extra_fields=['atom_id'])
+    author_structure = pdbx.get_structure(pdbxf, model=1, use_author_fields=True)
+    # same atom_site rows in the same order
+    structure.set_annotation('auth_chain_id', author_structure.chain_id)
+    structure.set_annotation('auth_res_id', author_structure.res_id)
+    return structure
+
+def load_complex(pdbcode, mirror=None):
+    """
+    Parses the mmCIF of an entry once and returns all atoms of model 1 with label chain & residue ids,
+    plus auth_chain_id & auth_res_id annotations. Parsed structures are kept in an in-process LRU,
+    so the returned AtomArray is shared and should not be modified in place.
+    """
+    return _load_complex_file(fetch_structure(pdbcode, load=False, mirror=mirror))
+
+def select_complex_atoms(ab_instance_ids, rbd_instance_id, atoms='CA', mirror=None):
+    """
+    Select antibody atoms and RBD atoms (author residues 319-541) of a complex.
+    atoms: 'CA' for backbone CA atoms or 'heavy' for all heavy atoms of amino acids
+    """
     # extract chain ids
     instance_ids = ab_instance_ids + [rbd_instance_id]
     chain_ids = [chainid.split('.')[1] for chainid in instance_ids]
     pdbcode = ab_instance_ids[0].split('.')[0]
     # load structure
-    struct = fetch_structure(pdbcode, chain=chain_ids, use_author_chain=False, extra_fields=['atom_id'])
-    struct = struct[struct.atom_name=='CA']
-    author_struct = fetch_structure(pdbcode, chain=None, use_author_chain=True, extra_fields=['atom_id'])
-    author_struct = author_struct[author_struct.atom_name=='CA']
+    struct = load_complex(pdbcode, mirror=mirror)
+    if atoms == 'CA':
+        struct = struct[filter_backbone(struct)]
+        atom_mask = struct.atom_name=='CA'
+    elif atoms == 'heavy':
+        struct = struct[struc.filter_amino_acids(struct)]
+        atom_mask = ~np.isin(struct.element, ['H', 'D'])
+    else:
+        raise ValueError('atoms must be CA or heavy')
+    all_chains = get_chains(struct)
+    for chain in chain_ids:
+        if chain not in all_chains:
+            raise ValueError(f'Chain {chain} not found in input file')
+    struct = struct[atom_mask & np.isin(struct.chain_id, chain_ids)]
     # seperate as ab & rbd
     rbd_chain_id = chain_ids.pop(-1)
     rbd_struct = struct[struct.chain_id==rbd_chain_id]
     ab_struct = struct[struct.chain_id!=rbd_chain_id]
-    # subset for only rbd part
-    rbd_struct_atomids = rbd_struct.atom_id
-    author_rbd_struct = author_struct[np.isin(author_struct.atom_id, rbd_struct_atomids)]
-    author_rbd_subset_struct = author_rbd_struct[np.isin(author_rbd_struct.res_id, np.arange(319,542))]
-    # coordinates
-    rbd_coords = author_rbd_subset_struct.coord
-    rbd_resids = author_rbd_subset_struct.res_id
-    ab_coords = ab_struct.coord
-    # distance
-    ab_rbd_dist = cdist(ab_coords, rbd_coords)
+    # subset for only rbd part by author residue ids
+    rbd_subset_struct = rbd_struct[np.isin(rbd_struct.auth_res_id, RBD_RESIDS)]
+    return ab_struct, rbd_subset_struct
+
+def calc_sparse_contacts(ab_struct, rbd_struct, threshold=8):
+    """
+    Contacts between antibody residues and RBD residues within the largest threshold,
+    found with KD-trees and reduced to the closest atom pair per residue pair.
+    Returns a DataFrame of ab_idx (index of antibody residue), ab_chain, ab_resid, rbd_resid & distance,
+    plus a within_{t} column per threshold if several are given.
+    """
+    thresholds = np.atleast_1d(threshold)
+    # residue index of each antibody atom
+    ab_res_starts = struc.get_residue_starts(ab_struct)
+    ab_res_idxs = np.searchsorted(ab_res_starts, np.arange(len(ab_struct)), side='right') - 1
+    # atom pairs within max threshold
+    pairs = cKDTree(ab_struct.coord).sparse_distance_matrix(cKDTree(rbd_struct.coord), thresholds.max(),
+                                                            output_type='ndarray')
+    contacts = pd.DataFrame(data={'ab_idx': ab_res_idxs[pairs['i']],
+                                  'rbd_resid': rbd_struct.auth_res_id[pairs['j']],
+                                  'distance': pairs['v']})
+    contacts = contacts.groupby(['ab_idx', 'rbd_resid'], as_index=False)['distance'].min()
+    contact_starts = ab_res_starts[contacts.ab_idx.values]
+    contacts.insert(1, 'ab_chain', ab_struct.chain_id[contact_starts])
+    contacts.insert(2, 'ab_resid', ab_struct.res_id[contact_starts])
+    if len(thresholds) > 1:
+        for t in thresholds:
+            contacts[f'within_{t:g}'] = contacts.distance <= t
+    return contacts
+
+def contacts_to_matrix(contacts, n_ab_residues, threshold=None):
+    """dense (antibody residues x 223 RBD residues) contact matrix of sparse contacts"""
+    if threshold is not None:
+        contacts = contacts.loc[contacts.distance <= threshold]
+    contacts_boolmask = np.zeros((n_ab_residues, len(RBD_RESIDS)), dtype=int)
+    contacts_boolmask[contacts.ab_idx.values, contacts.rbd_resid.values - RBD_RESIDS[0]] = 1
+    return contacts_boolmask
+
+def contacts_to_bitmap(contacts, id_col='complex_id', threshold=None):
+    """ids and id x RBD position (319-541) bitmap of contacted positions from sparse contacts of many complexes"""
+    if threshold is not None:
+        contacts = contacts.loc[contacts.distance <= threshold]
+    ids, id_idxs = np.unique(contacts[id_col].values, return_inverse=True)
+    bitmap = np.zeros((len(ids), len(RBD_RESIDS)), dtype=bool)
+    bitmap[id_idxs.reshape(-1), contacts.rbd_resid.values - RBD_RESIDS[0]] = True
+    return ids, bitmap
+
+def detect_rbd_contacts(ab_instance_ids, rbd_instance_id, threshold=8, atoms='CA', mirror=None):
+    """sparse antibody-RBD contacts of a complex, see calc_sparse_contacts"""
+    ab_struct, rbd_struct = select_complex_atoms(ab_instance_ids, rbd_instance_id, atoms=atoms, mirror=mirror)
+    return calc_sparse_contacts(ab_struct, rbd_struct, threshold=threshold)
+
+def detect_rbd_contacts_matrix(ab_instance_ids, rbd_instance_id, threshold=8, mirror=None):
+    # CA atoms of antibody & rbd
+    ab_struct, rbd_struct = select_complex_atoms(ab_instance_ids, rbd_instance_id, atoms='CA', mirror=mirror)
     # contacts
-    rbd_contacts_boolmask = ab_rbd_dist <= threshold
-    fulllen_contacts_boolmask = np.zeros((len(ab_rbd_dist), 223), dtype=int)
-    fulllen_contacts_boolmask[:, np.isin(np.arange(319,542), rbd_resids)] = rbd_contacts_boolmask
-    
-    return fulllen_contacts_boolmask
+    contacts = calc_sparse_contacts(ab_struct, rbd_struct, threshold=threshold)
+    return contacts_to_matrix(contacts, len(ab_struct))
+
+def _complex_contacts_job(complex_id, ab_instance_ids, rbd_instance_id, threshold, atoms, mirror):
+    start_time = time.time()
+    try:
+        contacts = detect_rbd_contacts(ab_instance_ids, rbd_instance_id, threshold=threshold, atoms=atoms, mirror=mirror)
+        return complex_id, contacts, time.time() - start_time, None
+    except Exception as e:
+        return complex_id, None, time.time() - start_time, f'{type(e).__name__}: {e}'
+
+def batch_rbd_contacts(complex_table, output_path, n_jobs=4, threshold=8, atoms='CA', mirror=None,
+                       ab_col='ab_instance_ids', rbd_col='rbd_instance_id', verbose=True):
+    """
+    Computes sparse RBD contacts of all complexes in a process pool and writes each complex
+    as soon as it finishes to a single SQLite file with tables contacts & complexes
+    (status, number of contacts, elapsed time, error).
+    Complexes already done in output_path are skipped, so interrupted runs can be resumed.
+    ab_col holds lists or comma-separated strings of antibody instance ids.
+    """
+    conn = sqlite3.connect(output_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS contacts (complex_id TEXT, ab_idx INTEGER, ab_chain TEXT, ab_resid INTEGER, rbd_resid INTEGER, distance REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS contacts_complex_id ON contacts (complex_id)")
+    conn.execute("CREATE TABLE IF NOT EXISTS complexes (complex_id TEXT PRIMARY KEY, status TEXT, n_contacts INTEGER, elapsed REAL, error TEXT)")
+    conn.commit()
+    done_ids = set(row[0] for row in conn.execute("SELECT complex_id FROM complexes WHERE status='done'"))
+    # complexes to run, grouped by entry so that parsed structures are reused within a worker
+    jobs = {}
+    for ab_ids, rbd_id in zip(complex_table[ab_col], complex_table[rbd_col]):
+        ab_ids = ab_ids.split(',') if isinstance(ab_ids, str) else list(ab_ids)
+        complex_id = ','.join(ab_ids) + '|' + rbd_id
+        if complex_id not in done_ids:
+            jobs[complex_id] = (ab_ids, rbd_id)
+    complex_ids = sorted(jobs.keys())
+    print(f'{len(done_ids)} complexes done, {len(complex_ids)} to run')
+    columns = ['ab_idx', 'ab_chain', 'ab_resid', 'rbd_resid', 'distance']
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        # submitted in sorted order, so complexes of an entry run close together
+        futures = {executor.submit(_complex_contacts_job, complex_id, jobs[complex_id][0], jobs[complex_id][1],
+                                   threshold, atoms, mirror): complex_id
+                   for complex_id in complex_ids}
+        for future in tqdm(as_completed(futures), total=len(futures), disable=not verbose):
+            try:
+                complex_id, contacts, elapsed, error = future.result()
+            except Exception as e:
+                # worker died
+                complex_id, contacts, elapsed, error = futures[future], None, None, f'{type(e).__name__}: {e}'
+            conn.execute("DELETE FROM contacts WHERE complex_id=?", (complex_id,))
+            if error is None:
+                rows = contacts[columns].itertuples(index=False, name=None)
+                conn.executemany("INSERT INTO contacts VALUES (?,?,?,?,?,?)",
+                                 ((complex_id, int(i), c, int(r), int(rr), float(d)) for i, c, r, rr, d in rows))
+                status = ('done', len(contacts))
+            else:
+                status = ('failed', None)
+            conn.execute("INSERT OR REPLACE INTO complexes VALUES (?,?,?,?,?)",
+                         (complex_id, status[0], status[1], elapsed, error))
+            conn.commit()
+    status_table = pd.read_sql("SELECT * FROM complexes", conn)
+    conn.close()
+    failed = status_table.loc[status_table.status=='failed']
+    if len(failed) > 0:
+        print(f'{len(failed)} complexes failed')
+    return status_table
+
+def load_batch_contacts(output_path, complex_ids=None):
+    """load contacts written by batch_rbd_contacts"""
+    conn = sqlite3.connect(output_path)
+    if complex_ids is None:
+        contacts = pd.read_sql("SELECT * FROM contacts", conn)
+    else:
+        complex_ids = list(complex_ids)
+        placeholders = ','.join(['?'] * len(complex_ids))
+        contacts = pd.read_sql(f"SELECT * FROM contacts WHERE complex_id IN ({placeholders})", conn, params=complex_ids)
+    conn.close()
+    return contacts